@@ -32,12 +32,16 @@
 #include <DallasTemperature.h>     // tested with version 3.7.6
 
 #define SERIAL_SPEED 9600
+#define MAX_SERIAL_SPEED 115200
+#define PROTOCOL_VERSION 2
 #define ECHO true
 #define WATCHDOG false
 
 String buf = "";                    // contains the received command
 char crc[9] = "\0\0\0\0\0\0\0\0\0"; // contains the NUL terminated received checksum of the command as hex representation of a 32bit number
 
+bool binary = false;                // set after a "switchProtocol" command (see the binary protocol notes below)
+
 FastCRC32 CRC32; // module for calculating crc checksums
 // CRC32 is a ridiculous overkill, but it is in the python standard library.
 
@@ -57,6 +61,10 @@ void setup() {
 
 void loop() { // each run of `loop` waits for one command, parses and executes it, prints its output, and returns
   buf = "";
+  if (binary) {
+    loopBinary();
+    return;
+  }
   char inByte;
   while (true) {                    // looping until we receive a delimiter character or the watchdog kills us
       inByte = busyRead();          // read one character
@@ -105,7 +113,72 @@ void loop() { // each run of `loop` waits for one command, parses and executes i
     }
 }
 
+////////////////////////////////////////////////////////////////////////////
+// Binary protocol.
+////////////////////////////////////////////////////////////////////////////
+
+// After "protocolVersion" (returning the version and the max baud rate) and
+// "switchProtocol baud_rate" (returning "0" before switching) the board talks
+// in frames without echo: STX, payload length, payload, CRC32 of the payload
+// (little-endian). The request payload is the ASCII command. The reply payload
+// is a status byte (0 for success, 1 for error) followed by the returned
+// values, each being a type byte ('i' or 'f') and a little-endian int32 or
+// float32. A watchdog reset returns the board to the ASCII protocol.
+
+void loopBinary() {
+  while (busyRead() != 2) {}        // wait for STX
+  byte len = busyRead();
+  for (byte i = 0; i < len; i++) {
+    buf += busyRead();
+  }
+  uint32_t received = 0;
+  for (byte i = 0; i < 4; i++) {
+    received |= ((uint32_t)(byte)busyRead()) << (8*i);
+  }
+  if (CRC32.crc32((uint8_t *)buf.c_str(), buf.length()) != received) {
+    reportError();
+    return;
+  }
+  executeCommand();
+}
+
+void sendFrame(byte status, String msg) { // converts the space separated numbers in `msg` to typed binary values
+  byte payload[255];
+  size_t n = 0;
+  payload[n++] = status;
+  int start = 0;
+  while (status == 0 && start < (int)msg.length() && n + 5 <= sizeof(payload)) {
+    int end = msg.indexOf(' ', start);
+    if (end < 0) end = msg.length();
+    String token = msg.substring(start, end);
+    if (token.indexOf('.') >= 0) {
+      float value = token.toFloat();
+      payload[n++] = 'f';
+      memcpy(payload + n, &value, 4);
+    } else {
+      long value = token.toInt();
+      payload[n++] = 'i';
+      memcpy(payload + n, &value, 4);
+    }
+    n += 4;
+    start = end + 1;
+  }
+  uint32_t crc = CRC32.crc32(payload, n);
+  Serial.write(2);                  // ascii STX
+  Serial.write((byte)n);
+  Serial.write(payload, n);
+  Serial.write((byte *)&crc, 4);
+}
+
+////////////////////////////////////////////////////////////////////////////
+// ASCII protocol.
+////////////////////////////////////////////////////////////////////////////
+
 void printWithCRC(String msg) { // TODO Subclass Serial
+  if (binary) {
+    sendFrame(0, msg);
+    return;
+  }
   Serial.println();
   Serial.print(msg);
   Serial.print("#");
@@ -116,7 +189,7 @@ void printWithCRC(String msg) { // TODO Subclass Serial
 char busyRead() {
   while (Serial.available()==0) {}
   char inByte = Serial.read();
-  if (ECHO) { // if set, echo the character back, so we see what we type
+  if (ECHO && !binary) { // if set, echo the character back, so we see what we type
     Serial.write(inByte);
   }
   return inByte;
@@ -133,6 +206,10 @@ void clearRemainingChars() {
 }
 
 void reportError() {
+  if (binary) {
+    sendFrame(1, "");
+    return;
+  }
   Serial.println();
   Serial.println("-"); 
   Serial.write(4); // ascii EOT
@@ -152,10 +229,18 @@ void executeCommand() { // TODO Write a dispatcher class
     anWrite();  
   }
 
+  else if (buf.startsWith("moveSteppers")) { // before "moveStepper" as it shares the prefix
+    moveSteppers();
+  }
+
   else if (buf.startsWith("moveStepper")) {
     moveStepper();
   }
 
+  else if (buf.startsWith("homeSteppers")) {
+    homeSteppers();
+  }
+
   else if (buf.startsWith("checkOrigin")) {
     checkOrigin();
   }
@@ -168,6 +253,14 @@ void executeCommand() { // TODO Write a dispatcher class
     setHeatFlow();
   }
 
+  else if (buf.startsWith("protocolVersion")) {
+    protocolVersion();
+  }
+
+  else if (buf.startsWith("switchProtocol")) {
+    switchProtocol();
+  }
+
   else {
     reportError();
   }
@@ -178,6 +271,8 @@ void executeCommand() { // TODO Write a dispatcher class
 // Commands' implementation.
 ////////////////////////////////////////////////////////////////////////////
 
+#define STEP_INCREMENT 10 // steps done by the stepper for each "step" of the move commands
+
 Stepper stepperx(4096, 23, 25, 27, 29);
 Stepper steppery(4096, 28, 26, 24, 22);
 int originx = 53;
@@ -225,16 +320,40 @@ void setupComponents() {
 void moveStepper() {
   int index = buf.indexOf(' ');
   if (buf[index+1] == 'x') {
-    if (buf[index+3] == '+') stepperx.step(10);
-    if (buf[index+3] == '-') stepperx.step(-10);
+    if (buf[index+3] == '+') stepperx.step(STEP_INCREMENT);
+    if (buf[index+3] == '-') stepperx.step(-STEP_INCREMENT);
   }
   else {
-    if (buf[index+3] == '+') steppery.step(10);
-    if (buf[index+3] == '-') steppery.step(-10);
+    if (buf[index+3] == '+') steppery.step(STEP_INCREMENT);
+    if (buf[index+3] == '-') steppery.step(-STEP_INCREMENT);
   }
   printWithCRC("0");
 }
 
+void moveSteppers() { // "moveSteppers dx dy" moves by signed number of increments on both axes
+  int index1 = buf.indexOf(' ');
+  int index2 = buf.indexOf(' ', index1 + 1);
+  int dx = buf.substring(index1 + 1, index2).toInt();
+  int dy = buf.substring(index2 + 1).toInt();
+  stepperx.step(STEP_INCREMENT*dx);
+  steppery.step(STEP_INCREMENT*dy);
+  printWithCRC("0");
+}
+
+void homeSteppers() { // "homeSteppers n" moves towards the origin (first x, then y) for at most n increments
+  int index = buf.indexOf(' ');
+  int budget = buf.substring(index + 1).toInt();
+  while (budget > 0 && digitalRead(originx)) {
+    stepperx.step(-STEP_INCREMENT);
+    budget -= 1;
+  }
+  while (budget > 0 && digitalRead(originy)) {
+    steppery.step(-STEP_INCREMENT);
+    budget -= 1;
+  }
+  checkOrigin();                    // reports whether the origin was reached
+}
+
 void checkOrigin() {
   String ret = "";
   ret += digitalRead(originx);
@@ -282,6 +401,28 @@ void setHeatFlow() {
   printWithCRC("0");
 }
 
+void protocolVersion() {
+  String ret = "";
+  ret += PROTOCOL_VERSION;
+  ret += ' ';
+  ret += MAX_SERIAL_SPEED;
+  printWithCRC(ret);
+}
+
+void switchProtocol() {
+  int index = buf.indexOf(' ');
+  long speed = buf.substring(index + 1).toInt();
+  if (speed <= 0 || speed > MAX_SERIAL_SPEED) {
+    reportError();
+    return;
+  }
+  printWithCRC("0");
+  Serial.flush();                   // wait for the reply to be sent at the old speed
+  Serial.end();
+  Serial.begin(speed);
+  binary = true;
+}
+
 void checkHeartBeat() {
   String ret = "";
   ret += millis();
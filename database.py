@@ -1,7 +1,12 @@
+import datetime
+import hashlib
 import io
+import itertools
 import logging
 import os.path
 import sqlite3
+import threading
+import time
 
 import numpy as np
 
@@ -12,35 +17,101 @@ logger = logging.getLogger('database')
 # Teach the database engine how to record numpy arrays.
 ###############################################################################
 
+# Arrays are stored as a single codec tag byte followed by the raw
+# little-endian values of the 4x5 matrix. Blobs written by older versions with
+# `np.save` start with the `.npy` magic string instead and are still readable.
+NPY_MAGIC = b'\x93NUMPY'
+array_codecs = {1: np.dtype('<f8'),  # double precision
+                2: np.dtype('<f4')}  # single precision (half the size)
+array_codec = 1 # The codec used for new records.
+
 def adapt_array(arr):
     '''Take a numpy array and return an sqlite record.'''
     arr = np.array(arr, dtype=float)
     assert arr.shape == (4,5), 'Data matrix should have 4 rows and 5 cols.'
-    out = io.BytesIO()
-    np.save(out, arr)
-    out.seek(0)
-    return sqlite3.Binary(out.read())
+    dtype = array_codecs[array_codec]
+    return sqlite3.Binary(bytes([array_codec]) + arr.astype(dtype).tobytes())
 
 def convert_array(text):
     '''Take an sqlite record and return a numpy array.'''
-    out = io.BytesIO(text)
-    out.seek(0)
-    return np.load(out)
+    if text.startswith(NPY_MAGIC):
+        out = io.BytesIO(text)
+        out.seek(0)
+        return np.load(out)
+    dtype = array_codecs[text[0]]
+    return np.frombuffer(text, dtype=dtype, offset=1).reshape(4,5).astype(float)
 
 sqlite3.register_adapter(np.ndarray, adapt_array)
 sqlite3.register_converter("REACTOR_ARRAY", convert_array)
 
+# The normalized schema (see `normalize_measurements`) stores each well in its
+# own numeric column. These SQL functions convert between the two layouts.
+well_columns = ['w%d%d'%(r+1,c+1) for r in range(4) for c in range(5)]
+
+def sql_reactor_array(*wells):
+    '''Pack the 20 well values in an sqlite record (SQL function `reactor_array`).'''
+    if wells[0] is None:
+        return None
+    return adapt_array(np.array(wells, dtype=float).reshape(4,5))
+
+def sql_array_item(record, index):
+    '''Return a single well value from an sqlite record (SQL function `array_item`).'''
+    if record is None:
+        return None
+    return float(convert_array(record).flat[index])
+
 
 ###############################################################################
 # Open the database file. If such file does not exists, create a new database.
 ###############################################################################
 
+class ConnectionManager:
+    '''Hand out a separate sqlite connection to each thread.
+
+    The manager can be used as a connection (`with db:`, `db.execute(...)`),
+    all calls are forwarded to the connection of the calling thread. The
+    database is in WAL mode, so readers never block writers (and vice versa).'''
+    busy_timeout = 10 # seconds to wait for a lock held by another connection
+    def __init__(self, db_file, read_only=False):
+        self.db_file = db_file
+        self.read_only = read_only
+        self.local = threading.local()
+    def connect(self):
+        '''Open a new connection configured for the reactor database.'''
+        if self.read_only:
+            conn = sqlite3.connect('file:%s?mode=ro'%self.db_file, uri=True,
+                                   timeout=self.busy_timeout,
+                                   detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+        else:
+            conn = sqlite3.connect(self.db_file,
+                                   timeout=self.busy_timeout,
+                                   detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+            conn.execute('PRAGMA journal_mode = WAL;')
+        conn.row_factory = sqlite3.Row
+        conn.create_function('reactor_array', len(well_columns), sql_reactor_array)
+        conn.create_function('array_item', 2, sql_array_item)
+        conn.execute('PRAGMA foreign_keys = ON;')
+        conn.execute('PRAGMA synchronous = NORMAL;') # Safe in WAL mode, fsyncs only on checkpoints.
+        return conn
+    def connection(self):
+        '''Return the connection of the calling thread (opening it if necessary).'''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+        return conn
+    def __getattr__(self, name):
+        return getattr(self.connection(), name)
+    def __enter__(self):
+        return self.connection().__enter__()
+    def __exit__(self, *args):
+        return self.connection().__exit__(*args)
+
 pwd = os.path.dirname(os.path.realpath(__file__))
 db_file = os.path.join(pwd, 'database.sqlite')
 new_db = not os.path.isfile(db_file)
-db = sqlite3.connect(db_file, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
-db.row_factory = sqlite3.Row
-db.execute('PRAGMA foreign_keys = ON;')
+db = ConnectionManager(db_file) # for everything
+db_ro = ConnectionManager(db_file, read_only=True) # for the readers in the web interface
+db.connection() # Creates the file (if necessary) and switches it to WAL mode.
 if new_db:
     logger.info('No database file detected. Preparing a new one...')
     db.executescript('''
@@ -140,6 +211,477 @@ if new_db:
     );
 ''')
 
+# Tables added after the original schema (created in older databases as well).
+db.executescript('''
+
+    -- Missed or late deadlines of the periodic events.
+    CREATE TABLE IF NOT EXISTS deadline_log (
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+        experiment_name TEXT REFERENCES experiments(name) ON DELETE CASCADE,
+        event TEXT NOT NULL,
+        lateness REAL NOT NULL,
+        missed INTEGER NOT NULL
+    );
+
+    -- Experiments whose measurements were moved to their own database file.
+    CREATE TABLE IF NOT EXISTS archives (
+        experiment_name TEXT PRIMARY KEY NOT NULL REFERENCES experiments(name) ON DELETE CASCADE,
+        file TEXT NOT NULL, -- in `archive_dir`
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+        rows INTEGER NOT NULL,
+        first TIMESTAMP,
+        last TIMESTAMP
+    );
+
+    -- Running statistics of the measurements of each experiment, per quantity
+    -- (of the means over the wells, well='all') and per well, updated with
+    -- every inserted measurement (see `summary_statements`).
+    CREATE TABLE IF NOT EXISTS summaries (
+        experiment_name TEXT NOT NULL REFERENCES experiments(name) ON DELETE CASCADE,
+        quantity TEXT NOT NULL, -- the measurement table
+        well TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        first TIMESTAMP NOT NULL,
+        last TIMESTAMP NOT NULL,
+        min REAL NOT NULL,
+        max REAL NOT NULL,
+        sum REAL NOT NULL,
+        sum_squares REAL NOT NULL,
+        last_value REAL NOT NULL,
+        PRIMARY KEY (experiment_name, quantity, well)
+    ) WITHOUT ROWID;
+
+    -- Hourly rollups of the means over the wells of each quantity.
+    CREATE TABLE IF NOT EXISTS hourly_summaries (
+        experiment_name TEXT NOT NULL REFERENCES experiments(name) ON DELETE CASCADE,
+        quantity TEXT NOT NULL,
+        hour TIMESTAMP NOT NULL,
+        count INTEGER NOT NULL,
+        min REAL NOT NULL,
+        max REAL NOT NULL,
+        sum REAL NOT NULL,
+        PRIMARY KEY (experiment_name, quantity, hour)
+    ) WITHOUT ROWID;
+''')
+
+
+###############################################################################
+# Write-behind buffer for the periodic inserts (reduces wear of flash drives).
+###############################################################################
+
+# The errors caused by a single statement (as opposed to the database being locked, full, ...).
+statement_errors = (sqlite3.IntegrityError, sqlite3.InterfaceError, sqlite3.ProgrammingError)
+
+class BufferedWriter:
+    '''Queue inserts in memory and write them in a single transaction.
+
+    The queue is flushed when it reaches `batch_size` rows, every `interval`
+    seconds (if the flushing thread was started with `start`), and on `stop`.'''
+    def __init__(self, interval=60, batch_size=100):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.queue = [] # Lists of `(query, params)`: the insert of a row and its statements.
+        self.queued_rows = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stop_thread = threading.Event()
+        self.thread = None
+        self.flushed_rows = 0
+        self.last_flush_latency = 0.
+        self.max_flush_latency = 0.
+        self.now = datetime.datetime.utcnow # The clock of default timestamps (virtual when simulating).
+        self.listeners = [] # Called with the table and the columns of each queued row.
+
+    def insert(self, table, statements=(), **columns):
+        '''Queue a row for insertion. The timestamp defaults to the current (UTC) time, as in the schema.
+
+        The `(query, params)` statements (e.g. the updates of the summaries)
+        run right after the row and are dropped with it if it can not be inserted.'''
+        columns.setdefault('timestamp', self.now())
+        names = sorted(columns)
+        query = '''INSERT INTO %s (%s) VALUES (%s)'''%(table, ', '.join(names), ', '.join('?'*len(names)))
+        with self.lock:
+            self.queue.append([(query, [columns[_] for _ in names])]+list(statements))
+            self.queued_rows += 1
+            full = self.queued_rows >= self.batch_size
+        for listener in self.listeners:
+            listener(table, columns)
+        if full:
+            self.try_flush()
+
+    def flush(self):
+        '''Write all queued rows in one transaction (one `executemany` per consecutive run of the same query).
+
+        If the transaction fails, the rows are written again one by one (each
+        with its statements) and only the ones failing on their own (e.g. a
+        duplicate timestamp) are logged and dropped. If the database cannot be
+        written at all (e.g. it is locked during a `VACUUM`), the rows are put
+        back at the front of the queue and the error is raised.'''
+        with self.flush_lock:
+            with self.lock:
+                queue, self.queue = self.queue, []
+                rows, self.queued_rows = self.queued_rows, 0
+            if not queue:
+                return
+            start = time.monotonic()
+            dropped = 0
+            try:
+                try:
+                    with db:
+                        statements = itertools.chain.from_iterable(queue)
+                        for query, group in itertools.groupby(statements, key=lambda _:_[0]):
+                            db.executemany(query, [params for _, params in group])
+                except statement_errors:
+                    with db:
+                        for group in queue:
+                            db.execute('''SAVEPOINT buffered_row''')
+                            try:
+                                for query, params in group:
+                                    db.execute(query, params)
+                            except statement_errors as e:
+                                db.execute('''ROLLBACK TO buffered_row''')
+                                logger.error('Dropped a buffered row (%s): %s', e, ' '.join(group[0][0].split()))
+                                dropped += 1
+                            db.execute('''RELEASE buffered_row''')
+            except Exception:
+                with self.lock:
+                    self.queue[:0] = queue
+                    self.queued_rows += rows
+                raise
+            self.last_flush_latency = time.monotonic()-start
+            self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+            self.flushed_rows += len(queue)-dropped
+        logger.info('Flushed %d rows in %.3fs.', len(queue)-dropped, self.last_flush_latency)
+
+    def try_flush(self):
+        '''Like `flush`, but log the errors instead of raising them (the rows then stay queued).'''
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Flushing the buffered rows failed, %d rows stay queued.', len(self.queue))
+
+    def report(self):
+        '''A short description of the queue depth and flush latency.'''
+        return 'BufferedWriter: %d queued, %d flushed, latency %.3fs (max %.3fs)'%(
+                len(self.queue), self.flushed_rows, self.last_flush_latency, self.max_flush_latency)
+
+    def start(self):
+        '''Start a thread flushing the queue every `interval` seconds.'''
+        if self.thread is not None and self.thread.is_alive():
+            raise ValueError('A flushing thread is already active')
+        self.stop_thread.clear()
+        def target():
+            while not self.stop_thread.wait(self.interval):
+                self.try_flush()
+        self.thread = threading.Thread(target=target, name='BufferedWriter')
+        self.thread.start()
+
+    def stop(self):
+        '''Stop the flushing thread and write whatever is still queued.'''
+        self.stop_thread.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+writer = BufferedWriter()
+
+
+###############################################################################
+# Summaries of the measurements, maintained on insert.
+###############################################################################
+
+summary_insert = '''INSERT OR IGNORE INTO summaries
+                    (experiment_name, quantity, well, count, first, last, min, max, sum, sum_squares, last_value)
+                    VALUES (?, ?, ?, 0, ?, ?, ?, ?, 0, 0, ?)'''
+summary_update = '''UPDATE summaries
+                    SET count=count+1, first=min(first, ?), last=max(last, ?), min=min(min, ?), max=max(max, ?),
+                        sum=sum+?, sum_squares=sum_squares+?, last_value=CASE WHEN ?>=last THEN ? ELSE last_value END
+                    WHERE experiment_name=? AND quantity=? AND well=?'''
+hourly_insert = '''INSERT OR IGNORE INTO hourly_summaries
+                   (experiment_name, quantity, hour, count, min, max, sum)
+                   VALUES (?, ?, ?, 0, ?, ?, 0)'''
+hourly_update = '''UPDATE hourly_summaries
+                   SET count=count+1, min=min(min, ?), max=max(max, ?), sum=sum+?
+                   WHERE experiment_name=? AND quantity=? AND hour=?'''
+
+def summary_statements(experiment, quantity, timestamp, data):
+    '''Return the `(query, params)` updating the summaries with a measurement (NaN values are skipped).'''
+    values = [('all', float(np.nanmean(data)))] if not np.isnan(data).all() else []
+    values += [(w, float(v)) for w, v in zip(well_columns, np.asarray(data).flat) if not np.isnan(v)]
+    statements = [(summary_insert, (experiment, quantity, w, timestamp, timestamp, v, v, v)) for w, v in values]
+    statements += [(summary_update, (timestamp, timestamp, v, v, v, v*v, timestamp, v, experiment, quantity, w))
+                   for w, v in values]
+    if values and values[0][0] == 'all':
+        hour = timestamp.replace(minute=0, second=0, microsecond=0)
+        v = values[0][1]
+        statements += [(hourly_insert, (experiment, quantity, hour, v, v)),
+                       (hourly_update, (v, v, v, experiment, quantity, hour))]
+    return statements
+
+def rebuild_summaries():
+    '''Compute the summaries again from all stored measurements, archived ones included (e.g. for measurements
+    older than the summaries).'''
+    with db:
+        db.execute('''DELETE FROM summaries''')
+        db.execute('''DELETE FROM hourly_summaries''')
+        archived = [_[0] for _ in db.execute('''SELECT experiment_name FROM archives ORDER BY experiment_name ASC''')]
+        for conn, source in [(db, 'the database')]+[(archive_connection(_), 'the archive of %s'%_) for _ in archived]:
+            for table in measurement_tables(conn):
+                logger.info('Summarizing %s in %s...', table, source)
+                rows = conn.execute('''SELECT timestamp, experiment_name, data AS "data [REACTOR_ARRAY]" FROM %s
+                                        ORDER BY timestamp ASC'''%table)
+                for r in rows:
+                    for query, params in summary_statements(r['experiment_name'], table, r['timestamp'], r['data']):
+                        db.execute(query, params)
+
+
+###############################################################################
+# Maintenance tools for the stored measurements.
+###############################################################################
+
+def measurement_tables(conn=db):
+    '''Return the names of all measurement tables or views (of the form quantity__unit).'''
+    with conn:
+        return [_[0] for _ in
+                conn.execute('''SELECT name FROM sqlite_master
+                              WHERE type IN ('table', 'view')
+                              AND name GLOB '*__*'
+                              ORDER BY name ASC''')]
+
+def is_normalized():
+    '''Check whether the measurements are kept in the normalized `measurements` table.'''
+    with db:
+        return db.execute('''SELECT count(*) FROM sqlite_master
+                              WHERE type='table' AND name='measurements' ''').fetchone()[0] > 0
+
+def migrate_array_codec(codec=None):
+    '''Rewrite all measurement arrays with the current (or the given) codec and reclaim the freed space.'''
+    global array_codec
+    if codec is not None:
+        array_codec = codec
+    if is_normalized():
+        logger.info('The normalized schema does not store arrays. Nothing to rewrite.')
+        return
+    for table in measurement_tables():
+        logger.info('Rewriting the arrays in %s with codec %d...', table, array_codec)
+        with db:
+            rows = db.execute('''SELECT rowid, data FROM %s'''%table).fetchall()
+            db.executemany('''UPDATE %s SET data=? WHERE rowid=?'''%table,
+                           ((r['data'], r['rowid']) for r in rows))
+    db.execute('VACUUM')
+
+def normalize_measurements():
+    '''Move all per-quantity tables into a single `measurements` table.
+
+    Each old table is replaced by a view of the same name (with an `INSTEAD OF
+    INSERT` trigger), so code reading or writing the old tables keeps working.'''
+    if is_normalized():
+        logger.info('The database is already normalized.')
+        return
+    tables = measurement_tables()
+    wells = ', '.join(well_columns)
+    with db:
+        db.execute('BEGIN')
+        db.execute('''
+        -- The quantities measured by the reactor (named like the old tables).
+        CREATE TABLE quantities (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL
+        )''')
+        db.execute('''
+        -- All measurements, one numeric column per well. The primary key
+        -- doubles as a covering index for per-experiment range scans.
+        CREATE TABLE measurements (
+            experiment_name TEXT NOT NULL REFERENCES experiments(name) ON DELETE CASCADE,
+            quantity_id INTEGER NOT NULL REFERENCES quantities(id) ON DELETE CASCADE,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            %s,
+            PRIMARY KEY (experiment_name, quantity_id, timestamp)
+        ) WITHOUT ROWID'''%', '.join('%s REAL'%w for w in well_columns))
+        for table in tables:
+            logger.info('Moving %s to the normalized measurements table...', table)
+            quantity_id = db.execute('''INSERT INTO quantities (name) VALUES (?)''',
+                                     (table,)).lastrowid
+            rows = db.execute('''SELECT timestamp, experiment_name, data FROM %s'''%table)
+            db.executemany('''INSERT INTO measurements
+                              (experiment_name, quantity_id, timestamp, %s)
+                              VALUES (?, ?, ?, %s)'''%(wells, ', '.join('?'*len(well_columns))),
+                           ([r['experiment_name'], quantity_id, r['timestamp']]
+                            +(list(r['data'].flat) if r['data'] is not None else [None]*len(well_columns))
+                            for r in rows.fetchall()))
+            db.execute('''DROP TABLE %s'''%table)
+            # Only `timestamp` keeps its declared type through the view. Select
+            # `data AS "data [REACTOR_ARRAY]"` to get arrays back.
+            db.execute('''CREATE VIEW %s (timestamp, experiment_name, data) AS
+                          SELECT timestamp, experiment_name, reactor_array(%s)
+                          FROM measurements WHERE quantity_id=%d'''%(table, wells, quantity_id))
+            db.execute('''CREATE TRIGGER %s__insert INSTEAD OF INSERT ON %s
+                          BEGIN
+                              INSERT INTO measurements (experiment_name, quantity_id, timestamp, %s)
+                              VALUES (NEW.experiment_name, %d, COALESCE(NEW.timestamp, CURRENT_TIMESTAMP), %s);
+                          END'''%(table, table, wells, quantity_id,
+                                   ', '.join('array_item(NEW.data, %d)'%i for i in range(len(well_columns)))))
+    db.execute('VACUUM')
+
+
+###############################################################################
+# Archiving of finished experiments (keeps the live database small).
+###############################################################################
+
+archive_dir = os.path.join(pwd, 'archive')
+archive_managers = {} # archive file -> read-only `ConnectionManager`
+archive_managers_lock = threading.Lock()
+
+def archive_file(experiment):
+    '''The (unique) name of the archive file of an experiment.'''
+    safe = ''.join(_ if _.isalnum() or _ in '-_' else '_' for _ in experiment)
+    return '%s-%s.sqlite'%(safe, hashlib.sha1(experiment.encode('utf8')).hexdigest()[:8])
+
+def archive_connection(experiment):
+    '''Return a (read-only) connection manager for the archive of an experiment, or None if it is not archived.'''
+    with db_ro:
+        row = db_ro.execute('''SELECT file FROM archives WHERE experiment_name=?''',
+                            (experiment,)).fetchone()
+    if row is None:
+        return None
+    with archive_managers_lock:
+        if row['file'] not in archive_managers:
+            archive_managers[row['file']] = ConnectionManager(os.path.join(archive_dir, row['file']),
+                                                              read_only=True)
+        return archive_managers[row['file']]
+
+def remove_archive_files(files):
+    '''Remove archive files (of deleted experiments) from `archive_dir` and forget their connection managers.'''
+    for file in files:
+        with archive_managers_lock:
+            archive_managers.pop(file, None)
+        for suffix in ['', '-wal', '-shm']:
+            try:
+                os.remove(os.path.join(archive_dir, file+suffix))
+            except FileNotFoundError:
+                pass
+
+def experiment_connections(experiment):
+    '''Return the (read-only) connection managers with measurements of an experiment.
+
+    That is the main database, preceded by the archive of the experiment if it
+    is archived (measurements inserted after the archiving, e.g. by another
+    process, stay in the main database).'''
+    conn = archive_connection(experiment)
+    return [db_ro] if conn is None else [conn, db_ro]
+
+# The experiment being run, which can not be archived (set by the scheduler).
+running_experiment = lambda: None
+
+def archive_experiment(experiment):
+    '''Move the measurements of an experiment to its own database file in `archive_dir`.
+
+    The experiment, strain and notes stay in the main database (they are also
+    copied, to make the archive self-contained) together with a summary row in
+    `archives`. The readers in `dataprocessing` load archived measurements
+    from the archive file (and any newer ones from the main database). The
+    running experiment can not be archived.'''
+    if archive_connection(experiment) is not None:
+        raise ValueError('Experiment %s is already archived.'%experiment)
+    if experiment == running_experiment():
+        raise ValueError('Experiment %s is running.'%experiment)
+    writer.flush() # The buffered measurements go to the archive too.
+    logger.info('Archiving experiment %s...', experiment)
+    os.makedirs(archive_dir, exist_ok=True)
+    file = archive_file(experiment)
+    path = os.path.join(archive_dir, file)
+    if os.path.exists(path): # Left over by an interrupted archiving.
+        os.remove(path)
+    tables = measurement_tables()
+    db.execute('''ATTACH DATABASE ? AS archive''', (path,))
+    try:
+        with db:
+            for table, condition in [('strains', 'name=(SELECT strain_name FROM main.experiments WHERE name=?)'),
+                                     ('experiments', 'name=?'),
+                                     ('notes', 'experiment_name=?')]:
+                db.execute('''CREATE TABLE archive.%s AS SELECT * FROM main.%s WHERE %s'''%(table, table, condition),
+                           (experiment,))
+            for table in tables:
+                db.execute('''CREATE TABLE archive.%s (
+                                  timestamp TIMESTAMP NOT NULL,
+                                  experiment_name TEXT NOT NULL,
+                                  data REACTOR_ARRAY NOT NULL
+                              )'''%table)
+                db.execute('''INSERT INTO archive.%s SELECT timestamp, experiment_name, data FROM main.%s
+                              WHERE experiment_name=? ORDER BY timestamp ASC'''%(table, table),
+                           (experiment,))
+                db.execute('''CREATE INDEX archive.%s__timestamp ON %s (timestamp)'''%(table, table))
+            rows, first, last = db.execute('''SELECT count(*), min(timestamp), max(timestamp) FROM (%s)'''%
+                                           ' UNION ALL '.join('SELECT timestamp FROM archive.%s'%_ for _ in tables)
+                                           if tables else (0, None, None)).fetchone()
+    finally:
+        db.execute('''DETACH DATABASE archive''')
+    with db:
+        if is_normalized():
+            db.execute('''DELETE FROM measurements WHERE experiment_name=?''', (experiment,))
+        else:
+            for table in tables:
+                db.execute('''DELETE FROM %s WHERE experiment_name=?'''%table, (experiment,))
+        db.execute('''INSERT INTO archives (experiment_name, file, rows, first, last)
+                      VALUES (?, ?, ?, ?, ?)''',
+                   (experiment, file, rows, first, last))
+    logger.info('Archived %d rows of experiment %s in %s.', rows, experiment, file)
+
+def finished_experiments(days=7):
+    '''Return the experiments (not archived yet, nor running) without new measurements for the given number of days.'''
+    cutoff = datetime.datetime.utcnow()-datetime.timedelta(days=days)
+    latest = ' UNION ALL '.join('SELECT experiment_name, timestamp FROM %s'%_ for _ in measurement_tables())
+    with db:
+        return [_[0] for _ in db.execute('''
+            SELECT name FROM experiments
+            WHERE name NOT IN (SELECT experiment_name FROM archives)
+            AND timestamp < ?
+            AND name NOT IN (SELECT experiment_name FROM (%s) WHERE timestamp >= ?)
+            ORDER BY timestamp ASC'''%(latest or 'SELECT NULL, NULL'), (cutoff, cutoff))
+            if _[0] != running_experiment()]
+
+def vacuum():
+    '''Write the buffered rows, reclaim the space of deleted rows and truncate the write-ahead log.'''
+    writer.flush()
+    db.execute('''VACUUM''')
+    db.execute('''PRAGMA wal_checkpoint(TRUNCATE)''')
+
+class Maintenance:
+    '''Periodically archive the finished experiments (after `archive_after` days) and `vacuum` the database.'''
+    def __init__(self, interval=24*3600, archive_after=7):
+        self.interval = interval
+        self.archive_after = archive_after
+        self.stop_thread = threading.Event()
+        self.thread = None
+
+    def run(self):
+        for experiment in finished_experiments(self.archive_after):
+            archive_experiment(experiment)
+        logger.info('Vacuuming the database...')
+        vacuum()
+
+    def start(self):
+        '''Start a thread running the maintenance every `interval` seconds.'''
+        if self.thread is not None and self.thread.is_alive():
+            raise ValueError('A maintenance thread is already active')
+        self.stop_thread.clear()
+        def target():
+            while not self.stop_thread.wait(self.interval):
+                try:
+                    self.run()
+                except Exception:
+                    logger.exception('The database maintenance failed.')
+        self.thread = threading.Thread(target=target, name='Maintenance', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''Stop the maintenance thread (waiting for a running maintenance to finish).'''
+        self.stop_thread.set()
+        if self.thread is not None:
+            self.thread.join()
+
+maintenance = Maintenance()
+
 
 ###############################################################################
 # Add or remove mock data to the database.
@@ -196,6 +738,7 @@ def add_mock_data():
                             'You, little bacteria, are my only true friend!',
                             'Yay, happy hour!',
                             'Buffalo'+' buffalo'*200+'.'])])
+    rebuild_summaries()
 
 def del_mock_data():
     '''Delete the mock data (relies on automatic CASCADEing).'''
@@ -255,3 +798,45 @@ Vivamus maximus.
 
 if new_db:
     add_mock_data()
+
+
+###############################################################################
+# Command line access to the maintenance tools.
+###############################################################################
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Maintenance of the reactor database.')
+    commands = parser.add_subparsers(dest='command')
+    migrate_arrays = commands.add_parser('migrate_arrays',
+                                         help='Rewrite all stored arrays with the compact codec.')
+    migrate_arrays.add_argument('--float32', action='store_true',
+                                help='Store single instead of double precision floats.')
+    commands.add_parser('normalize',
+                        help='Move the per-quantity tables into a single measurements table.')
+    archive = commands.add_parser('archive',
+                                  help='Move experiments to their own files in the archive directory.')
+    archive.add_argument('experiments', nargs='*',
+                         help='The experiments to archive (by default the finished ones).')
+    archive.add_argument('--days', type=float, default=7,
+                         help='Days without measurements after which an experiment is finished.')
+    commands.add_parser('vacuum',
+                        help='Reclaim the space of deleted rows.')
+    commands.add_parser('summarize',
+                        help='Compute the summaries again from all stored measurements.')
+    args = parser.parse_args()
+    if args.command == 'migrate_arrays':
+        migrate_array_codec(2 if args.float32 else 1)
+    elif args.command == 'normalize':
+        normalize_measurements()
+    elif args.command == 'archive':
+        for experiment in args.experiments or finished_experiments(args.days):
+            archive_experiment(experiment)
+        vacuum()
+    elif args.command == 'vacuum':
+        vacuum()
+    elif args.command == 'summarize':
+        rebuild_summaries()
+    else:
+        parser.print_help()
@@ -1,24 +1,140 @@
+import ast
 import collections
 import itertools
+import threading
 
 import numpy as np
 import pandas as pd
 
-from database import db
+from database import (db_ro, measurement_tables, is_normalized, well_columns, archive_connection,
+                      experiment_connections)
 
 
+# The measurement tables (or views) are cached, to avoid a scan of
+# `sqlite_master` on every read. The cache is refreshed on a miss.
+known_tables = set(measurement_tables())
+
+def check_table(table):
+    '''Raise an error if `table` is not one of the measurement tables.'''
+    global known_tables
+    if table not in known_tables:
+        known_tables = set(measurement_tables())
+    assert table in known_tables, 'No such table.'
+
+###############################################################################
+# In-memory cache of the dataframes (the measurement tables are append-only).
+###############################################################################
+
+max_cached_rows = 200000 # Least recently used dataframes are evicted beyond this.
+frame_cache = collections.OrderedDict() # (experiment, table or name) -> (signature, dataframe)
+frame_cache_lock = threading.Lock()
+
+def cache_get(key):
+    '''Return the cached `(signature, dataframe)` for a key (or None).'''
+    with frame_cache_lock:
+        entry = frame_cache.get(key)
+        if entry is not None:
+            frame_cache.move_to_end(key)
+        return entry
+
+def cache_put(key, signature, df):
+    '''Cache a dataframe, evicting the least recently used ones if there are too many rows in the cache.'''
+    with frame_cache_lock:
+        frame_cache[key] = (signature, df)
+        frame_cache.move_to_end(key)
+        rows = sum(len(_) for __, _ in frame_cache.values())
+        while rows > max_cached_rows and len(frame_cache) > 1:
+            __, (__, evicted) = frame_cache.popitem(last=False)
+            rows -= len(evicted)
+
+def forget_experiment(experiment=None):
+    '''Drop all cached dataframes of an experiment, or of all experiments (necessary when rows are deleted).'''
+    with frame_cache_lock:
+        for key in [_ for _ in frame_cache if experiment is None or _[0] == experiment]:
+            del frame_cache[key]
+
+def query_experiment(experiment, table, since=None):
+    '''Read the rows of a measurement table for a given experiment (only the ones newer than `since` if given).
+
+    Archived experiments are read from their archive file (followed by the
+    rows inserted in the main database after the archiving).'''
+    # The explicit type also converts the data of the normalized schema views.
+    query = '''SELECT timestamp, experiment_name, data AS "data [REACTOR_ARRAY]" FROM %s
+               WHERE experiment_name=? %s ORDER BY timestamp ASC'''%(table, '' if since is None else 'AND timestamp>?')
+    params = (experiment,) if since is None else (experiment, since)
+    frames = [pd.read_sql_query(query,
+                                conn.connection(),
+                                index_col='timestamp',
+                                params=params)
+              for conn in experiment_connections(experiment)
+              if conn is db_ro or table in measurement_tables(conn)] # The table may be newer than the archive.
+    frames = [_ for _ in frames if len(_)] or frames[-1:]
+    return frames[0] if len(frames) == 1 else pd.concat(frames).sort_index(kind='stable')
+
 def read_experiment(experiment, table):
-    '''Read one of the measurement tables or notes for a given experiment as a dataframe.'''
-    with db:
-        all_tables = [_[0] for _ in
-                      db.execute('''SELECT name FROM sqlite_master
-                                    WHERE type='table'
-                                    AND name GLOB '*__*' ''')]
-    assert table in all_tables+['notes'], 'No such table.'
-    df = pd.read_sql_query('SELECT * FROM %s WHERE experiment_name=? ORDER BY timestamp ASC'%table,
-                           db,
+    '''Read one of the measurement tables or notes for a given experiment as a dataframe.
+
+    Measurement tables are cached and only rows newer than the last read are
+    fetched from the database. The returned dataframe is shared with the
+    cache, hence it should not be modified.'''
+    if table == 'notes':
+        return pd.read_sql_query('SELECT * FROM notes WHERE experiment_name=? ORDER BY timestamp ASC',
+                                 db_ro.connection(),
+                                 index_col='timestamp',
+                                 params=(experiment,))
+    check_table(table)
+    entry = cache_get((experiment, table))
+    if entry is None or not len(entry[1]):
+        df = query_experiment(experiment, table)
+    else:
+        df = entry[1]
+        new = query_experiment(experiment, table, since=pd.Timestamp(df.index[-1]).to_pydatetime())
+        if not len(new):
+            return df
+        df = pd.concat([df, new])
+    cache_put((experiment, table), None, df)
+    return df
+
+def read_derived(experiment, name, tables, compute):
+    '''Return `compute(*dataframes_of_tables)`, cached until one of the tables gets new rows.'''
+    frames = [read_experiment(experiment, _) for _ in tables]
+    signature = tuple(len(_) for _ in frames)
+    entry = cache_get((experiment, name))
+    if entry is not None and entry[0] == signature:
+        return entry[1]
+    df = compute(*frames)
+    cache_put((experiment, name), signature, df)
+    return df
+
+def read_wells(experiment, table, start=None, end=None):
+    '''Read the per-well values of a measurement table in a (optional) time range as a dataframe.
+
+    With the normalized schema this is a range scan over the numeric columns
+    which does not decode any arrays.'''
+    check_table(table)
+    # The bounds may be strings or pandas timestamps (which sqlite can not bind).
+    start = None if start is None else pd.Timestamp(start).to_pydatetime()
+    end = None if end is None else pd.Timestamp(end).to_pydatetime()
+    if not is_normalized() or archive_connection(experiment) is not None:
+        df = read_experiment(experiment, table)
+        if start is not None:
+            df = df[df.index >= start]
+        if end is not None:
+            df = df[df.index <= end]
+        return pd.DataFrame(stack_data(df).reshape(-1,20), index=df.index, columns=well_columns)
+    conditions = ['experiment_name=?', 'quantity_id=(SELECT id FROM quantities WHERE name=?)']
+    params = [experiment, table]
+    if start is not None:
+        conditions.append('timestamp>=?')
+        params.append(start)
+    if end is not None:
+        conditions.append('timestamp<=?')
+        params.append(end)
+    df = pd.read_sql_query('''SELECT timestamp, %s FROM measurements
+                              WHERE %s ORDER BY timestamp ASC'''%(', '.join(well_columns), ' AND '.join(conditions)),
+                           db_ro.connection(),
                            index_col='timestamp',
-                           params=(experiment,))
+                           params=params)
     return df
 
 
@@ -26,43 +142,139 @@ def read_experiment(experiment, table):
 # Tools for calculating variables of interested dependent on logged variables.
 ###############################################################################
 
+# The names permitted in strain formulae, besides the variable `x`.
+formula_names = {name: getattr(np, name) for name in
+                 ['abs', 'sqrt', 'cbrt', 'square', 'exp', 'exp2', 'expm1', 'log', 'log2', 'log10', 'log1p', 'power',
+                  'sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan', 'arctan2', 'hypot', 'sinh', 'cosh', 'tanh',
+                  'minimum', 'maximum', 'fmin', 'fmax', 'clip', 'floor', 'ceil', 'rint', 'round', 'sign',
+                  'pi', 'e', 'nan', 'inf']}
+number_node = ast.Constant if hasattr(ast, 'Constant') else ast.Num
+formula_nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, number_node,
+                 ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.USub, ast.UAdd)
+
+def small_exponent(node):
+    '''Whether `node` is a number (or a negated one) of at most 100 in magnitude.'''
+    while isinstance(node, ast.UnaryOp):
+        node = node.operand
+    return isinstance(node, number_node) and abs(ast.literal_eval(node)) <= 100
+
+def compile_formula(formula):
+    '''Compile a formula of `x` to a function working on whole numpy arrays. Raise `ValueError` if not permitted.'''
+    try:
+        tree = ast.parse(formula.strip(), mode='eval')
+    except SyntaxError:
+        raise ValueError('Formula "%s" is not a valid expression.'%formula)
+    for node in ast.walk(tree):
+        if not isinstance(node, formula_nodes):
+            raise ValueError('Formula "%s" contains a forbidden %s.'%(formula, type(node).__name__))
+        if isinstance(node, ast.Name) and node.id != 'x' and node.id not in formula_names:
+            raise ValueError('Formula "%s" uses an unknown name "%s".'%(formula, node.id))
+        if isinstance(node, ast.Call) and (node.keywords or not isinstance(node.func, ast.Name)
+                                           or not callable(formula_names.get(node.func.id))):
+            raise ValueError('Formula "%s" contains a forbidden call.'%formula)
+        if isinstance(node, number_node) and not isinstance(ast.literal_eval(node), (int, float)):
+            raise ValueError('Formula "%s" contains a non-numeric constant.'%formula)
+        # Powers of (python) numbers are computed exactly, e.g. 10**10**10 would never end.
+        if (isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow)
+            and not any(isinstance(_, ast.Name) and _.id == 'x' for _ in ast.walk(node))
+            and not small_exponent(node.right)):
+            raise ValueError('Formula "%s" contains a power of constants with a large or computed exponent.'%formula)
+    code = compile(tree, '<formula>', 'eval')
+    names = dict(formula_names, __builtins__={})
+    function = lambda x: eval(code, names, {'x': x})
+    try: # Catch the remaining errors (e.g. `log+x`) before the formula is used.
+        with np.errstate(all='ignore'):
+            function(np.linspace(0.1, 2, 20).reshape(4,5))
+    except Exception as e:
+        raise ValueError('Formula "%s" can not be evaluated (%s).'%(formula, e))
+    return function
+
+# Compiled formulae for each (strain, formula column) pair.
+compiled_formulas = {}
+
+def forget_strain(strain):
+    '''Drop the compiled formulae of a strain (and the dataframes derived with them).'''
+    for key in [_ for _ in compiled_formulas if _[0] == strain]:
+        del compiled_formulas[key]
+    forget_experiment()
+
 def parse_formula(experiment, formula):
     '''Return a python function corresponding to the given formula and experiment's strain.'''
-    with db:
-        query = db.execute('''SELECT strain_name FROM experiments
-                              WHERE name=?''',
-                           (experiment,))
+    with db_ro:
+        query = db_ro.execute('''SELECT strain_name FROM experiments
+                                 WHERE name=?''',
+                              (experiment,))
         strain = query.fetchone()[0]
-        query = db.execute('''SELECT %s FROM strains
-                              WHERE name=?'''%formula,
-                           (strain,))
-        formula = query.fetchone()[0]
-    formula = eval('lambda x:'+formula, np.__dict__)
-    return formula
+    return strain_formula(strain, formula)
+
+def strain_formula(strain, formula):
+    '''Return a python function corresponding to the given formula of a strain.'''
+    if (strain, formula) not in compiled_formulas:
+        with db_ro:
+            query = db_ro.execute('''SELECT %s FROM strains
+                                     WHERE name=?'''%formula,
+                                  (strain,))
+            try:
+                compiled_formulas[strain, formula] = compile_formula(query.fetchone()[0])
+            except ValueError as e:
+                raise ValueError('Strain %s: %s Edit the strain to fix it.'%(strain, e))
+    return compiled_formulas[strain, formula]
+
+# The formula columns of the strains.
+formula_columns = ['light_ratio_to_od_formula', 'od_to_biomass_formula', 'od_to_cell_count_formula']
+
+def invalid_formulae():
+    '''Return the `(strain, column, error)` of each stored formula rejected by `compile_formula`.
+
+    Formulae saved before they were checked may use names that are not
+    permitted anymore. The quantities derived with them can not be computed
+    until the strain is edited.'''
+    invalid = []
+    with db_ro:
+        strains = db_ro.execute('''SELECT name, %s FROM strains ORDER BY name ASC'''%', '.join(formula_columns)).fetchall()
+    for strain in strains:
+        for column in formula_columns:
+            try:
+                compile_formula(strain[column])
+            except ValueError as e:
+                invalid.append((strain['name'], column, str(e)))
+    return invalid
+
+def apply_formula(experiment, formula, data):
+    '''Apply one of the strain formulae to a whole (N,4,5) array at once.'''
+    out = np.empty_like(data)
+    with np.errstate(all='ignore'):
+        out[...] = parse_formula(experiment, formula)(data)
+    return out
 
 def read_OD(experiment):
     '''Prepare a dataframe of OD values.'''
-    light_in  = read_experiment(experiment, 'light_in__uEm2s')
-    light_out = read_experiment(experiment, 'light_out__uEm2s')
-    OD = light_in.copy()
-    OD['data'] = light_out['data']/light_in['data']
-    formula = parse_formula(experiment, 'light_ratio_to_od_formula')
-    OD['data'] = OD['data'].apply(formula)
-    return OD
+    def compute(light_in, light_out):
+        ratio = stack_data(light_out.reindex(light_in.index))/stack_data(light_in)
+        OD = light_in.copy()
+        OD['data'] = unstack_data(apply_formula(experiment, 'light_ratio_to_od_formula', ratio))
+        return OD
+    return read_derived(experiment, 'OD', light_tables, compute)
+
+def read_from_OD(experiment, formula):
+    '''Prepare a dataframe of a quantity calculated from the (shared, cached) OD values.'''
+    def compute(light_in, light_out):
+        OD = read_OD(experiment)
+        df = OD.copy()
+        df['data'] = unstack_data(apply_formula(experiment, formula, stack_data(OD)))
+        return df
+    return read_derived(experiment, formula, light_tables, compute)
 
 def read_cell_count(experiment):
-    '''Prepare a dataframe of biomass values.'''
-    OD = read_OD(experiment)
-    formula = parse_formula(experiment, 'od_to_cell_count_formula')
-    OD['data'] = OD['data'].apply(formula)
-    return OD
+    '''Prepare a dataframe of cell count values.'''
+    return read_from_OD(experiment, 'od_to_cell_count_formula')
 
 def read_biomass(experiment):
     '''Prepare a dataframe of biomass values.'''
-    OD = read_OD(experiment)
-    formula = parse_formula(experiment, 'od_to_biomass_formula')
-    OD['data'] = OD['data'].apply(formula)
-    return OD
+    return read_from_OD(experiment, 'od_to_biomass_formula')
+
+# The tables necessary for the derived quantities above.
+light_tables = ['light_in__uEm2s', 'light_out__uEm2s']
 
 
 ###############################################################################
@@ -70,7 +282,7 @@ def read_biomass(experiment):
 ###############################################################################
 
 # A convenient container for everything necessary to define a plot.
-PlotType = collections.namedtuple('PlotType', ['reader', 'min', 'max'])
+PlotType = collections.namedtuple('PlotType', ['reader', 'min', 'max', 'tables'])
 
 # Most of the database-to-dataframe functions need to read a single table,
 # so we are making a function that returns such reader functions.
@@ -78,39 +290,369 @@ make_reader = lambda table: lambda experiment: read_experiment(experiment, table
 
 # A container of all predefined plots.
 possible_plots = collections.OrderedDict([
-        ('light in'      , PlotType(make_reader('light_in__uEm2s') ,  0,  3)),
-        ('light out'     , PlotType(make_reader('light_out__uEm2s'),  0,  3)),
-        ('temperature'   , PlotType(make_reader('temperature__C')  , 20, 40)),
-        ('added water'   , PlotType(make_reader('water__ml')       ,  0,  5)),
-        ('added media'   , PlotType(make_reader('media__ml')       ,  0,  5)),
-        ('drained volume', PlotType(make_reader('drained__ml')     ,  0,  5)),
-        ('OD'            , PlotType(read_OD                        ,  0,  3)),
-        ('cell count'    , PlotType(read_cell_count                ,  0,  3)),
-        ('biomass'       , PlotType(read_biomass                   ,  0,  3)),
+        ('light in'      , PlotType(make_reader('light_in__uEm2s') ,  0,  3, ['light_in__uEm2s'] )),
+        ('light out'     , PlotType(make_reader('light_out__uEm2s'),  0,  3, ['light_out__uEm2s'])),
+        ('temperature'   , PlotType(make_reader('temperature__C')  , 20, 40, ['temperature__C']  )),
+        ('added water'   , PlotType(make_reader('water__ml')       ,  0,  5, ['water__ml']       )),
+        ('added media'   , PlotType(make_reader('media__ml')       ,  0,  5, ['media__ml']       )),
+        ('drained volume', PlotType(make_reader('drained__ml')     ,  0,  5, ['drained__ml']     )),
+        ('OD'            , PlotType(read_OD                        ,  0,  3, light_tables        )),
+        ('cell count'    , PlotType(read_cell_count                ,  0,  3, light_tables        )),
+        ('biomass'       , PlotType(read_biomass                   ,  0,  3, light_tables        )),
         ])
 
+def last_change(experiment, tables):
+    '''Return the row count and newest timestamp of each of the given tables (or notes) for an experiment.'''
+    for table in tables:
+        if table != 'notes':
+            check_table(table)
+    query = ' UNION ALL '.join('''SELECT count(*), max(timestamp) FROM %s
+                                   WHERE experiment_name=?'''%table
+                               for table in tables)
+    with db_ro:
+        rows = db_ro.execute(query, (experiment,)*len(tables)).fetchall()
+    return tuple(tuple(r) for r in rows)
+
+# The columns derived from the 4x5 data matrix of each measurement.
+plottype_columns = (['avg', 'median', 'min', 'max']
+                   +['r%d'%(r+1) for r in range(4)]
+                   +['c%d'%(c+1) for c in range(5)]
+                   +['%s%s'%(r+1,c+1) for r,c in itertools.product(range(4),range(5))])
+
+def stack_data(df):
+    '''Decode the `data` column of a dataframe into a single contiguous (N,4,5) array.
+
+    Missing entries (e.g. from reindexing) become matrices of NaNs.'''
+    data = np.empty((len(df),4,5))
+    for i, d in enumerate(df['data']):
+        data[i] = np.nan if d is None else d
+    return data
+
+def unstack_data(data):
+    '''The inverse of `stack_data`, i.e. an object array of (4,5) matrices for a `data` column.'''
+    column = np.empty(len(data), dtype=object)
+    for i, d in enumerate(data):
+        column[i] = d
+    return column
+
+def plottype_frame(df):
+    '''Compute all columns of interest (see `plottype_columns`) from a dataframe with a `data` column.'''
+    return wells_frame(stack_data(df).reshape(-1,20), df.index)
+
+def wells_frame(wells, index):
+    '''Compute all columns of interest (see `plottype_columns`) from an (N,20) array of well values.'''
+    data = wells.reshape(-1,4,5)
+    values = np.empty((len(data), len(plottype_columns)))
+    values[:,0] = wells.mean(axis=1)
+    values[:,1] = np.median(wells, axis=1)
+    values[:,2] = wells.min(axis=1)
+    values[:,3] = wells.max(axis=1)
+    values[:,4:8] = data.mean(axis=2)
+    values[:,8:13] = data.mean(axis=1)
+    values[:,13:] = wells
+    return pd.DataFrame(values, index=index, columns=plottype_columns)
+
 def read_plottype(experiment, plot_type):
-    '''Prepare a dataframe with all the data of interest for a given experiment and plot type.'''
-    df = plot_type.reader(experiment)
-    del df['experiment_name']
-    df['avg'] = df['data'].apply(lambda _:_.mean())
-    df['median'] = df['data'].apply(lambda _:np.median(_))
-    df['min'] = df['data'].apply(lambda _:_.min())
-    df['max'] = df['data'].apply(lambda _:_.max())
-    for r in range(4):
-        df['r%d'%(r+1)] = df['data'].apply(lambda _:_[r,:].mean())
-    for c in range(5):
-        df['c%d'%(c+1)] = df['data'].apply(lambda _:_[:,c].mean())
-    for r,c in itertools.product(range(4),range(5)):
-        df['%s%s'%(r+1,c+1)]=df['data'].apply(lambda _:_[r,c])
-    del df['data']
+    '''Prepare a dataframe with all the data of interest for a given experiment and plot type (cached).'''
+    # The frame only depends on the reader (the plot type itself is not hashable, its tables are a list).
+    return read_derived(experiment, ('plot type', plot_type.reader), plot_type.tables,
+                        lambda *_: plottype_frame(plot_type.reader(experiment)))
+
+def read_window(experiment, plot_type, columns=None, start=None, end=None):
+    '''Like `read_plottype`, restricted to some of the columns and to a (inclusive) time range.
+
+    With the normalized schema, the time range of the plot types reading a
+    single table is a range scan (see `read_wells`) instead of a slice of the
+    whole experiment.'''
+    if (start is not None or end is not None) and len(plot_type.tables) == 1 and is_normalized():
+        wells = read_wells(experiment, plot_type.tables[0], start, end)
+        df = wells_frame(wells.values, wells.index)
+    else:
+        df = read_plottype(experiment, plot_type)
+    if columns is not None:
+        unknown = set(columns)-set(plottype_columns)
+        if unknown:
+            raise ValueError('Unknown columns: %s.'%', '.join(sorted(unknown)))
+        df = df[list(columns)]
+    if start is not None:
+        df = df[df.index >= pd.Timestamp(start)]
+    if end is not None:
+        df = df[df.index <= pd.Timestamp(end)]
     return df
 
+downsample_methods = ['mean', 'minmax', 'lttb']
+
+def downsample(df, max_points, method='mean'):
+    '''Reduce a dataframe to at most `max_points` rows with one of the `downsample_methods`.
+
+    - `mean` averages groups of consecutive rows (ignoring NaNs), labeled with
+      the timestamp of their middle row.
+    - `minmax` keeps the envelope: for each group of rows, the minimum and the
+      maximum of each column (in their order of appearance) as two rows.
+    - `lttb` keeps the rows chosen by Largest-Triangle-Three-Buckets on the
+      first column (the other columns are sampled on the same rows).'''
+    if method not in downsample_methods:
+        raise ValueError('The downsampling method should be one of %s.'%', '.join(downsample_methods))
+    if max_points is None or len(df) <= max_points:
+        return df
+    if max_points < {'mean': 1, 'minmax': 2, 'lttb': 3}[method]:
+        raise ValueError('Too few points for the %s method.'%method)
+    if method == 'minmax':
+        return downsample_minmax(df, max_points//2)
+    if method == 'lttb':
+        return df.iloc[lttb_rows(df.index.asi8.astype(float), df.values[:,0], max_points)]
+    starts = np.arange(max_points)*len(df)//max_points
+    ends = np.append(starts[1:], len(df))
+    values = df.values
+    valid = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(valid, values, 0), starts)
+    counts = np.add.reduceat(valid.astype(int), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums/counts
+    return pd.DataFrame(means, index=df.index[(starts+ends-1)//2], columns=df.columns)
+
+def downsample_minmax(df, groups):
+    '''The `minmax` method of `downsample` (with two rows per group).'''
+    starts = np.arange(groups)*len(df)//groups
+    lengths = np.diff(np.append(starts, len(df)))
+    values = df.values
+    lows = np.fmin.reduceat(values, starts)
+    highs = np.fmax.reduceat(values, starts)
+    # The first row of each group where the extremes are reached.
+    rows = np.arange(len(df))[:,None]
+    low_at = np.minimum.reduceat(np.where(values == np.repeat(lows, lengths, axis=0), rows, len(df)), starts)
+    high_at = np.minimum.reduceat(np.where(values == np.repeat(highs, lengths, axis=0), rows, len(df)), starts)
+    low_first = low_at <= high_at
+    envelope = np.empty((2*groups, values.shape[1]))
+    envelope[0::2] = np.where(low_first, lows, highs)
+    envelope[1::2] = np.where(low_first, highs, lows)
+    positions = np.empty(2*groups, dtype=int)
+    positions[0::2] = starts+lengths//4
+    positions[1::2] = starts+3*lengths//4
+    return pd.DataFrame(envelope, index=df.index[positions], columns=df.columns)
+
+def lttb_rows(x, y, n):
+    '''The indices of the `n` points of a curve kept by Largest-Triangle-Three-Buckets.
+
+    The first and last points are kept, and for each bucket in between, the
+    point making the largest triangle with the previously kept point and the
+    average of the next bucket. NaNs are never kept, unless a bucket is all NaN.'''
+    edges = np.linspace(1, len(x)-1, n-1).astype(int)
+    valid = ~np.isnan(y)
+    kept = [0]
+    for i in range(n-2):
+        start, end = edges[i], edges[i+1]
+        next_start, next_end = (end, edges[i+2]) if i+3 < n else (len(x)-1, len(x))
+        next_valid = valid[next_start:next_end]
+        if next_valid.any():
+            next_x = x[next_start:next_end][next_valid].mean()
+            next_y = y[next_start:next_end][next_valid].mean()
+        else:
+            next_x, next_y = x[next_start], y[kept[-1]]
+        a = kept[-1]
+        area = np.abs((x[a]-next_x)*(y[start:end]-y[a])-(x[a]-x[start:end])*(next_y-y[a]))
+        kept.append(start+int(np.argmax(np.where(np.isnan(area), -1, area))))
+    kept.append(len(x)-1)
+    return np.array(kept)
+
+def read_table_window(experiment, rows, after=None, before=None, resolution=None):
+    '''Return the timestamps of (at most) `rows` consecutive measurements of any plot type after (or before) a
+    timestamp, and the dataframe of each plot type (in `possible_plots` order) reindexed on them.
+
+    Only the requested window of the wide table of `read_all_plottypes` is built.
+    With a `resolution` (in seconds) the rows come from `read_grid` instead.'''
+    if resolution is not None:
+        grid = read_grid(experiment, resolution)
+        if before is not None:
+            end = grid.index.searchsorted(pd.Timestamp(before), side='left')
+            start = max(0, end-rows)
+        else:
+            start = 0 if after is None else grid.index.searchsorted(pd.Timestamp(after), side='right')
+            end = start+rows
+        return grid.index[start:end], [grid[_].iloc[start:end] for _ in possible_plots]
+    frames = [read_plottype(experiment, _) for _ in possible_plots.values()]
+    candidates = []
+    for df in frames:
+        if before is not None:
+            i = df.index.searchsorted(pd.Timestamp(before), side='left')
+            candidates.append(df.index.values[max(0, i-rows):i])
+        else:
+            i = 0 if after is None else df.index.searchsorted(pd.Timestamp(after), side='right')
+            candidates.append(df.index.values[i:i+rows])
+    window = np.unique(np.concatenate(candidates))
+    window = pd.DatetimeIndex(window[-rows:] if before is not None else window[:rows], name='timestamp')
+    if not len(window):
+        return window, [df.iloc[:0] for df in frames]
+    return window, [df[(df.index >= window[0]) & (df.index <= window[-1])].reindex(window) for df in frames]
+
 def read_all_plottypes(experiment, interpolate=True):
-    '''Like `read_plottype` but for all defined plot types. Interpolation is optional.'''
+    '''Like `read_plottype` but for all defined plot types.
+
+    If interpolated, this is the (one minute) `read_grid`, otherwise the union
+    of the timestamps of all plot types, with missing values.'''
+    if interpolate:
+        return read_grid(experiment)
     ts = [read_plottype(experiment,v) for v in possible_plots.values()]
     df = pd.concat([_.transpose() for _ in ts], keys=possible_plots.keys()).transpose()
     df.columns.names = ['plot type', 'well']
-    if interpolate:
-        df.interpolate(method='time', limit_direction='both')
     return df
+
+# The tables behind all plot types (each is read once for a grid).
+grid_tables = sorted(set(itertools.chain(*[_.tables for _ in possible_plots.values()])))
+
+# The bounds of the grid resolution (in seconds) and the maximal number of grid rows (about 120 MB).
+grid_resolutions = (1, 30*24*3600)
+max_grid_rows = 100000
+
+def read_grid(experiment, resolution=60):
+    '''All plot types of an experiment on a shared grid of timestamps, `resolution` seconds apart (cached).
+
+    The measurements are averaged in each step of the grid and the steps
+    without measurements are interpolated in time (the first and last values
+    extend to the edges). The result is a float32 dataframe with (plot type,
+    column) columns. Raise `ValueError` if the resolution is out of
+    `grid_resolutions` or the grid would have more than `max_grid_rows` rows.'''
+    if not grid_resolutions[0] <= resolution <= grid_resolutions[1]: # Also false for NaN.
+        raise ValueError('The resolution should be between %d and %d seconds.'%grid_resolutions)
+    def compute(*tables):
+        # The plot types are derived from the (cached) tables, OD related ones share the OD.
+        frames = [read_plottype(experiment, _) for _ in possible_plots.values()]
+        columns = pd.MultiIndex.from_product([list(possible_plots), plottype_columns], names=['plot type', 'well'])
+        step = int(resolution*1e9)
+        # In nanoseconds, whatever the resolution of the index (sqlite timestamps are read as microseconds).
+        stamps = [df.index.values.astype('datetime64[ns]').view('i8') for df in frames]
+        times = [_ for _ in stamps if len(_)]
+        if not times:
+            return pd.DataFrame(np.empty((0, len(columns)), dtype=np.float32), columns=columns,
+                                index=pd.DatetimeIndex([], name='timestamp'))
+        first = min(_[0] for _ in times)//step*step
+        last = max(_[-1] for _ in times)
+        if (last-first)//step >= max_grid_rows:
+            raise ValueError('The experiment is too long for a resolution of %g seconds, at least %d are needed.'%(
+                             resolution, -(-(last-first)//max_grid_rows)//10**9+1))
+        grid = np.arange(first, last+step, step)
+        values = np.empty((len(grid), len(columns)), dtype=np.float32)
+        width = len(plottype_columns)
+        for k, (df, ns) in enumerate(zip(frames, stamps)):
+            means = np.empty((len(grid), width))
+            means.fill(np.nan)
+            if len(df):
+                steps, starts = np.unique((ns-first)//step, return_index=True)
+                valid = ~np.isnan(df.values)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    means[steps] = (np.add.reduceat(np.where(valid, df.values, 0), starts)
+                                    /np.add.reduceat(valid.astype(int), starts))
+            for c in range(width):
+                known = ~np.isnan(means[:,c])
+                if known.any():
+                    means[:,c] = np.interp(grid, grid[known], means[known,c])
+            values[:,k*width:(k+1)*width] = means
+        return pd.DataFrame(values, columns=columns,
+                            index=pd.DatetimeIndex(grid.astype('datetime64[ns]'), name='timestamp'))
+    return read_derived(experiment, ('grid', resolution), grid_tables, compute)
+
+
+###############################################################################
+# Overview of experiments from the summaries (without reading the measurements).
+###############################################################################
+
+def read_summaries(experiment):
+    '''Return the summaries of an experiment (a row per quantity and well, with `mean` and `std` columns).'''
+    df = pd.read_sql_query('''SELECT * FROM summaries WHERE experiment_name=?
+                              ORDER BY quantity ASC, well ASC''',
+                           db_ro.connection(),
+                           params=(experiment,))
+    df['mean'] = df['sum']/df['count']
+    df['std'] = np.sqrt(np.maximum(df['sum_squares']/df['count']-df['mean']**2, 0))
+    return df
+
+def read_hourly_summaries(experiment, quantity):
+    '''Return the hourly rollups of the means over the wells of a quantity (with a `mean` column).'''
+    df = pd.read_sql_query('''SELECT hour, count, min, max, sum FROM hourly_summaries
+                              WHERE experiment_name=? AND quantity=?
+                              ORDER BY hour ASC''',
+                           db_ro.connection(),
+                           index_col='hour',
+                           params=(experiment, quantity))
+    df['mean'] = df['sum']/df['count']
+    return df
+
+def read_overviews(experiments):
+    '''Return an overview of each of the given `(name, strain)` experiments from their summaries (in one query).
+
+    Each overview is a dict with the `first` and `last` measurement times, the
+    `duration` (a timedelta), the number of `measurements`, the mean and std of
+    the temperature (of the means over the wells) and the `final OD` (the mean
+    over the wells of the OD of the last light measurements). Missing values
+    are None.'''
+    overviews = {name: {'first': None, 'last': None, 'duration': None, 'measurements': 0,
+                        'temperature': None, 'temperature std': None, 'final OD': None}
+                 for name, strain in experiments}
+    if not experiments:
+        return overviews
+    with db_ro:
+        rows = db_ro.execute('''SELECT * FROM summaries
+                                 WHERE experiment_name IN (%s)
+                                 AND (well='all' OR quantity IN (?, ?))'''%', '.join('?'*len(experiments)),
+                             [name for name, strain in experiments]+light_tables).fetchall()
+    last_light = collections.defaultdict(lambda: {_: np.empty(len(well_columns))*np.nan for _ in light_tables})
+    for r in rows:
+        overview = overviews[r['experiment_name']]
+        if r['well'] == 'all':
+            overview['first'] = min(overview['first'] or r['first'], r['first'])
+            overview['last'] = max(overview['last'] or r['last'], r['last'])
+            overview['measurements'] += r['count']
+            if r['quantity'] == 'temperature__C':
+                mean = r['sum']/r['count']
+                overview['temperature'] = mean
+                overview['temperature std'] = max(r['sum_squares']/r['count']-mean**2, 0)**0.5
+        else:
+            last_light[r['experiment_name']][r['quantity']][well_columns.index(r['well'])] = r['last_value']
+    for name, strain in experiments:
+        overview = overviews[name]
+        if overview['first'] is not None:
+            overview['duration'] = overview['last']-overview['first']
+        if name in last_light:
+            light_in, light_out = (last_light[name][_] for _ in light_tables)
+            try:
+                formula = strain_formula(strain, 'light_ratio_to_od_formula')
+            except ValueError: # A stored formula which is not permitted anymore (see `invalid_formulae`).
+                continue
+            with np.errstate(all='ignore'):
+                OD = formula(light_out/light_in)
+            if not np.isnan(OD).all():
+                overview['final OD'] = float(np.nanmean(OD))
+    return overviews
+
+
+###############################################################################
+# Benchmark of the dataframe preparation (run this file as a script).
+###############################################################################
+
+if __name__ == '__main__':
+    import timeit
+
+    def plottype_frame_apply(df):
+        '''The row-by-row implementation `plottype_frame` replaced (for reference).'''
+        df = df.copy()
+        df['avg'] = df['data'].apply(lambda _:_.mean())
+        df['median'] = df['data'].apply(lambda _:np.median(_))
+        df['min'] = df['data'].apply(lambda _:_.min())
+        df['max'] = df['data'].apply(lambda _:_.max())
+        for r in range(4):
+            df['r%d'%(r+1)] = df['data'].apply(lambda _:_[r,:].mean())
+        for c in range(5):
+            df['c%d'%(c+1)] = df['data'].apply(lambda _:_[:,c].mean())
+        for r,c in itertools.product(range(4),range(5)):
+            df['%s%s'%(r+1,c+1)]=df['data'].apply(lambda _:_[r,c])
+        del df['data']
+        return df
+
+    for n in [10000, 100000]:
+        index = pd.date_range('2017-01-01', periods=n, freq='min', name='timestamp')
+        df = pd.DataFrame({'data': list(np.random.random((n,4,5)))}, index=index)
+        assert np.allclose(plottype_frame(df).values, plottype_frame_apply(df).values)
+        t_apply = min(timeit.repeat(lambda: plottype_frame_apply(df), number=1, repeat=3))
+        t_vectorized = min(timeit.repeat(lambda: plottype_frame(df), number=1, repeat=3))
+        print('%6d rows: apply %.3fs, vectorized %.3fs, speedup %.0fx'%(
+              n, t_apply, t_vectorized, t_apply/t_vectorized))
@@ -0,0 +1,191 @@
+import io
+import itertools
+import json
+import logging
+import re
+import zipfile
+
+import numpy as np
+
+from database import db_ro, measurement_tables, well_columns, experiment_connections
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger('database')
+
+
+###############################################################################
+# Reading the experiments in chunks.
+###############################################################################
+
+# The formats of the exported measurements (columnar ones need pyarrow).
+export_formats = (['parquet', 'feather'] if pyarrow else [])+['npz']
+default_format = export_formats[0]
+
+def experiment_metadata(experiment):
+    '''The description, strain (with its formulae) and notes of an experiment as a JSON-able dict.'''
+    with db_ro:
+        row = db_ro.execute('''SELECT * FROM experiments WHERE name=?''', (experiment,)).fetchone()
+        if row is None:
+            raise ValueError('No such experiment: %s.'%experiment)
+        metadata = dict(row)
+        metadata['strain'] = dict(db_ro.execute('''SELECT * FROM strains WHERE name=?''',
+                                                (metadata['strain_name'],)).fetchone() or {})
+        metadata['notes'] = [dict(_) for _ in db_ro.execute('''SELECT timestamp, note FROM notes
+                                                              WHERE experiment_name=?
+                                                              ORDER BY timestamp ASC''',
+                                                           (experiment,))]
+    return metadata
+
+def file_name(experiment):
+    '''A name for the files of an experiment: only ASCII letters, digits, `.`, `_`, `+` and `-`, not starting with a dot.'''
+    return re.sub(r'[^A-Za-z0-9._+-]', '_', experiment).lstrip('.') or 'experiment'
+
+def read_chunks(experiment, table, chunk=10000):
+    '''Return the number of rows of a measurement table for an experiment and an iterator over chunks of them.
+
+    The chunks are `(timestamps, data)` arrays (datetime64 and (N,4,5)). Only
+    the rows present when this is called are read (also by the iterator).
+    Archived experiments are read from their archive file, followed by the
+    rows inserted in the main database after the archiving.'''
+    assert table in measurement_tables(), 'No such table.'
+    ranges = []
+    for conn in experiment_connections(experiment):
+        if table not in measurement_tables(conn): # A table created after the experiment was archived.
+            continue
+        with conn:
+            count, until = conn.execute('''SELECT count(*), max(timestamp) AS "until [TIMESTAMP]" FROM %s
+                                           WHERE experiment_name=?'''%table,
+                                        (experiment,)).fetchone()
+        if count:
+            ranges.append((conn, count, until))
+    def chunks(conn, until):
+        since = None
+        while since != until:
+            with conn:
+                rows = conn.execute('''SELECT timestamp, data AS "data [REACTOR_ARRAY]" FROM %s
+                                       WHERE experiment_name=? AND timestamp<=? %s
+                                       ORDER BY timestamp ASC LIMIT ?'''%(table, '' if since is None else 'AND timestamp>?'),
+                                    (experiment, until)+(() if since is None else (since,))+(chunk,)).fetchall()
+            if not rows:
+                return
+            since = rows[-1][0]
+            yield (np.array([_[0] for _ in rows], dtype='datetime64[ns]'),
+                   np.array([_[1] for _ in rows], dtype=float).reshape(-1,4,5))
+    return (sum(count for __, count, __ in ranges),
+            itertools.chain.from_iterable(chunks(conn, until) for conn, __, until in ranges))
+
+
+###############################################################################
+# Writing the archive (one directory per experiment in a zip file).
+###############################################################################
+
+def write_npy(archive, name, count, chunks):
+    '''Write the chunks of a table as one structured `.npy` array (`timestamp` and `data` fields) without holding it in memory.'''
+    dtype = np.dtype([('timestamp', '<M8[ns]'), ('data', '<f8', (4,5))])
+    with archive.open(name+'.npy', 'w', force_zip64=True) as f:
+        np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                 'fortran_order': False,
+                                                 'shape': (count,)})
+        for timestamps, data in chunks:
+            records = np.empty(len(timestamps), dtype=dtype)
+            records['timestamp'] = timestamps
+            records['data'] = data
+            f.write(records.tobytes())
+            yield
+
+def write_columnar(archive, name, fmt, chunks):
+    '''Write the chunks of a table as numbered Parquet or Feather files (`timestamp` and one column per well).'''
+    write = pyarrow.parquet.write_table if fmt == 'parquet' else pyarrow.feather.write_feather
+    for i, (timestamps, data) in enumerate(chunks):
+        wells = data.reshape(-1,20)
+        table = pyarrow.Table.from_arrays([pyarrow.array(timestamps)]+[pyarrow.array(wells[:,_]) for _ in range(20)],
+                                          names=['timestamp']+well_columns)
+        f = io.BytesIO()
+        write(table, f)
+        archive.writestr('%s/%05d.%s'%(name, i, fmt), f.getvalue())
+        yield
+
+def export_steps(experiments, fileobj, fmt=default_format, chunk=10000):
+    '''Write a zip archive of the experiments in a file object (which does not need to be seekable).
+
+    Each experiment gets a directory (named by `file_name`, numbered if
+    taken), with an `experiment.json` of its metadata, strain and notes, and
+    one entry for each measurement table. Yield after each chunk, i.e. the
+    archive is written incrementally.'''
+    if fmt not in export_formats:
+        raise ValueError('The export format should be one of %s.'%', '.join(export_formats))
+    tables = sorted(measurement_tables())
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED if fmt == 'npz' else zipfile.ZIP_STORED) as archive:
+        directories = set()
+        for experiment in experiments:
+            logger.info('Exporting experiment %s...', experiment)
+            directory = base = file_name(experiment)
+            for i in itertools.count(2):
+                if directory not in directories:
+                    break
+                directory = '%s-%d'%(base, i)
+            directories.add(directory)
+            archive.writestr('%s/experiment.json'%directory,
+                             json.dumps(experiment_metadata(experiment), indent=1, default=str))
+            for table in tables:
+                count, chunks = read_chunks(experiment, table, chunk)
+                if not count:
+                    continue
+                name = '%s/%s'%(directory, table)
+                if fmt == 'npz':
+                    yield from write_npy(archive, name, count, chunks)
+                else:
+                    yield from write_columnar(archive, name, fmt, chunks)
+    yield
+
+class StreamSink:
+    '''A write-only file object keeping the written bytes until they are taken (to stream an archive).'''
+    def __init__(self):
+        self.chunks = []
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    def flush(self):
+        pass
+    def take(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+def stream_archive(experiments, fmt=default_format, chunk=10000):
+    '''Yield the bytes of the archive of `export_steps`, as they are written.'''
+    sink = StreamSink()
+    for __ in export_steps(experiments, sink, fmt, chunk):
+        data = sink.take()
+        if data:
+            yield data
+    yield sink.take()
+
+
+###############################################################################
+# Command line access to the export (run this file as a script).
+###############################################################################
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Export experiments to a zip archive.')
+    parser.add_argument('output', help='The zip file to write.')
+    parser.add_argument('experiments', nargs='*', help='The experiments to export (all by default).')
+    parser.add_argument('--format', choices=export_formats, default=default_format,
+                        help='The file format of the measurements (default: %(default)s).')
+    parser.add_argument('--chunk', type=int, default=10000,
+                        help='The number of rows read and written at a time.')
+    args = parser.parse_args()
+    experiments = args.experiments
+    if not experiments:
+        with db_ro:
+            experiments = [_[0] for _ in db_ro.execute('''SELECT name FROM experiments ORDER BY timestamp ASC''')]
+    with open(args.output, 'wb') as f:
+        for __ in export_steps(experiments, f, args.format, args.chunk):
+            pass
@@ -72,14 +72,22 @@ import webbrowser
 
 from web import start_web_interface_thread, stop_web_interface_thread
 from scheduler import start_scheduler_thread, stop_scheduler_thread
+from database import writer, maintenance
+from dataprocessing import invalid_formulae
+from reactor import reactor, SerialManager
 
 
 def report(*threads):
-    return '\n    '.join('%s: %s'%(t.name, t.is_alive()) for t in threads)
+    return '\n    '.join(['%s: %s'%(t.name, t.is_alive()) for t in threads]
+                          +[writer.report()]
+                          +([reactor.report()] if isinstance(reactor, SerialManager) else []))
 
+for strain, column, error in invalid_formulae():
+    logger.warning('Strain %s, %s: %s Edit the strain in the web interface.', strain, column, error)
 logger.info('Starting scheduler and web threads...')
 scheduler_thread = start_scheduler_thread()
 web_interface_thread = start_web_interface_thread()
+maintenance.start()
 webbrowser.open('http://localhost:8080', new=1, autoraise=True)
 try:
     while True:
@@ -89,5 +97,6 @@ try:
 except KeyboardInterrupt:
     logger.info('Interrupted by user. Shutting down...')
 logger.info('Stopping scheduler and web threads...')
+maintenance.stop()
 stop_scheduler_thread()
 stop_web_interface_thread()
@@ -1,18 +1,53 @@
+import functools
+import json
+
 from bokeh.embed import components
 from bokeh.layouts import gridplot
-from bokeh.models import ColumnDataSource, Range1d, Rect, HoverTool
+from bokeh.models import ColumnDataSource, CustomJS, Range1d, Rect, HoverTool
 from bokeh.plotting import figure
 
-from dataprocessing import possible_plots, read_plottype, read_experiment, read_all_plottypes
+from dataprocessing import possible_plots, read_plottype, read_experiment, read_all_plottypes, last_change, downsample
+
+
+# The number of points drawn in each figure (the downsampling keeps the
+# envelope of the data). Zooming in fetches the visible range from `/api/data`
+# at the same number of points, i.e. at full resolution when zoomed enough.
+plot_points = 1000
+plot_method = 'minmax'
 
+# Fetch the data of the visible range (shortly after the last change of the range).
+zoom_js = '''
+clearTimeout(window.zoom_timeout);
+window.zoom_timeout = setTimeout(function() {
+    var start = new Date(cb_obj.start).toISOString().slice(0, -1);
+    var end = new Date(cb_obj.end).toISOString().slice(0, -1);
+    var http = new XMLHttpRequest();
+    http.onreadystatechange = function() {
+        if (http.readyState == 4 && http.status == 200) {
+            source.data = JSON.parse(http.responseText);
+            source.trigger('change');
+        }
+    };
+    http.open("GET", "/api/data?experiment="+encodeURIComponent(%(experiment)s)
+                    +"&plot_type="+encodeURIComponent(%(plot_type)s)
+                    +"&start="+start+"&end="+end
+                    +"&max_points=%(points)d&method=%(method)s");
+    http.send();
+}, 300);
+'''
 
-def full_plot(experiment, plot_type):
+def full_plot(experiment, plot_type, points=plot_points, method=plot_method):
     '''Generate a bokeh plot for a given experiment/plot combination.'''
-    plot_type = possible_plots[plot_type]
+    df = read_plottype(experiment, possible_plots[plot_type])
+    notes = read_experiment(experiment, 'notes')
+    return plot_layout(experiment, plot_type, df, notes, points, method)
+
+def plot_layout(experiment, plot_type, df, notes, points=plot_points, method=plot_method):
+    '''Lay out the figures of a plot type (the data is downsampled to `points` unless it is None).'''
+    name, plot_type = plot_type, possible_plots[plot_type]
 
     # Prepare the data.
-    df = read_plottype(experiment, plot_type)
-    ds = ColumnDataSource(df)
+    ds = ColumnDataSource(downsample(df, points, method))
 
     # Summary plot (average over all wells).
     tools = 'pan,wheel_zoom,box_zoom,reset,resize,crosshair'
@@ -23,6 +58,12 @@ def full_plot(experiment, plot_type):
     right  = df.index.max()
     range_y = Range1d(bottom, top)
     range_x = Range1d(left, right)
+    if points is not None:
+        range_x.callback = CustomJS(args={'source': ds},
+                                    code=zoom_js%{'experiment': json.dumps(experiment),
+                                                  'plot_type': json.dumps(name),
+                                                  'points': points,
+                                                  'method': method})
     p_mean = figure(width=350, height=350, x_axis_type='datetime',
 		    toolbar_location=None, tools=tools,
                     x_range=range_x, y_range=range_y,
@@ -34,7 +75,7 @@ def full_plot(experiment, plot_type):
     p_mean.legend.background_fill_alpha = 0.5
 
     # Add hover notes to the summary plot.
-    notes = read_experiment(experiment, 'notes')
+    notes = notes.copy()
     notes['str_date'] = notes.index.map(lambda _:_.strftime('%Y-%m-%d %H:%M:%S'))
     notes_ds = ColumnDataSource(notes)
     box = Rect(height=top-bottom,
@@ -91,6 +132,33 @@ def full_plot(experiment, plot_type):
 
 
 def full_plot_html(experiment, plot_type):
+    '''Return the html of `full_plot`, cached until new data or notes are added to the experiment.'''
+    tables = possible_plots[plot_type].tables+['notes']
+    return cached_full_plot_html(experiment, plot_type, last_change(experiment, tables))
+
+@functools.lru_cache(maxsize=32)
+def cached_full_plot_html(experiment, plot_type, last_change):
+    '''Generate the html for a plot. The `last_change` argument is used only as part of the cache key.'''
     final_plot = full_plot(experiment, plot_type)
     bokeh_script, bokeh_div = components(final_plot)
     return bokeh_div+'\n'+bokeh_script
+
+
+###############################################################################
+# Benchmark of the page payload (run this file as a script).
+###############################################################################
+
+if __name__ == '__main__':
+    import numpy as np
+    import pandas as pd
+
+    from dataprocessing import plottype_frame
+
+    for days in [1, 7, 28, 56]:
+        n = days*24*60 # one measurement per minute
+        index = pd.date_range('2017-01-01', periods=n, freq='min', name='timestamp')
+        df = plottype_frame(pd.DataFrame({'data': list(np.random.random((n,4,5)))}, index=index))
+        notes = pd.DataFrame({'note': []}, index=pd.DatetimeIndex([], name='timestamp'))
+        full, downsampled = [sum(map(len, components(plot_layout('benchmark', 'OD', df, notes, points))))
+                             for points in [None, plot_points]]
+        print('%2d days (%6d rows): full %6.1fMB, downsampled %4.2fMB'%(days, n, full/1e6, downsampled/1e6))
@@ -1,15 +1,22 @@
 import binascii
+import bisect
+import collections
+import concurrent.futures
+import datetime
 import glob
+import itertools
 import logging
 import os.path
+import queue
 import serial
+import struct
 import subprocess
 import threading
 import time
 
 import numpy as np
 
-from database import db
+from database import writer
 
 logger = logging.getLogger('arduino')
 
@@ -17,64 +24,278 @@ logger = logging.getLogger('arduino')
 class ComProtocolError(Exception):
     pass
 
+class ConnectionLost(ComProtocolError):
+    pass
+
+
+###############################################################################
+# Finding the Arduino USB device through sysfs.
+###############################################################################
+
+def read_sysfs(directory, name):
+    '''Read an attribute file in sysfs (None if not present).'''
+    try:
+        with open(os.path.join(directory, name)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def usb_device(port):
+    '''Return the sysfs directory of the USB device behind a serial port (e.g. /dev/ttyACM0).'''
+    tty = os.path.basename(os.path.realpath(port))
+    return os.path.realpath(os.path.join('/sys/class/tty', tty, 'device', '..'))
+
+def find_port(serial_number):
+    '''Return the serial port of the USB device with the given serial number (None if not connected).'''
+    if serial_number is None:
+        return None
+    for tty in sorted(glob.glob('/sys/class/tty/ttyACM*')):
+        port = os.path.join('/dev', os.path.basename(tty))
+        if read_sysfs(usb_device(port), 'serial') == serial_number:
+            return port
+    return None
+
+
 
 class SerialManager:
+    '''Talk to the Arduino over the serial port.
+
+    The Arduino starts with the human friendly ASCII protocol (with echo) at
+    9600 baud. If its sketch supports it, the connection is switched to a
+    faster baud rate and a binary protocol: frames of STX, payload length,
+    payload, and little-endian CRC32 of the payload. Requests carry the ASCII
+    command. Replies carry a status byte followed by typed values (`i` for
+    int32, `f` for float32, little-endian). Old sketches stay on ASCII.
+
+    Commands are queued and sent by a single I/O thread, in order of priority
+    (see `priorities`). `submit` returns a future, `send` waits for it.'''
+    baudrate = 9600 # The ASCII protocol speed (after every reset of the Arduino).
+    fast_baudrate = 115200 # The speed requested for the binary protocol.
+    protocol_version = 2
+    # Priorities of commands (lower is sent first) and the time they may wait in the queue.
+    priorities = {b'setHeatFlow': 0, b'getTemperatures': 1}
+    default_priority = 5
+    timeouts = {b'setHeatFlow': 10}
+    default_timeout = 120
+    # Upper bounds (in seconds) of the bins of the latency histograms.
+    latency_bins = [0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, float('inf')]
+    max_backoff = 60 # Maximal wait (in seconds) between attempts to reconnect.
     def __init__(self, port):
         self.port = port
-        self.serial = serial.Serial(port=self.port, baudrate=9600, timeout=4)
+        self.serial_number = read_sysfs(usb_device(port), 'serial') # Survives renumbering of the port.
+        self.lock = threading.RLock()
+        self.try_binary = True
+        self.connected = threading.Event()
+        self.reconnect_thread = None
+        self.resets = 0
+        self.downtime = 0.
+        self.connect()
+        self.connected.set()
+        self.requests = queue.PriorityQueue()
+        self.sequence = itertools.count() # keeps the order of commands with the same priority
+        self.latencies = collections.defaultdict(lambda: [0]*len(self.latency_bins))
+        # A daemon, because the I/O thread only waits for commands from the other threads.
+        self.io_thread = threading.Thread(target=self.process_requests, name='SerialIO', daemon=True)
+        self.io_thread.start()
+    def submit(self, msg, debug=True, priority=None, timeout=None):
+        '''Queue a command and return a future for the list of returned numbers.
+
+        If the command waits in the queue for longer than `timeout` seconds,
+        it is not sent and the future raises `ComProtocolError`.'''
+        command = msg.split(b' ')[0]
+        if priority is None:
+            priority = self.priorities.get(command, self.default_priority)
+        if timeout is None:
+            timeout = self.timeouts.get(command, self.default_timeout)
+        future = concurrent.futures.Future()
+        now = time.monotonic()
+        self.requests.put((priority, next(self.sequence), now, now+timeout, msg, debug, future))
+        return future
+    def send(self, msg, debug=True, priority=None, timeout=None):
+        '''Send a command and return the list of returned numbers (blocking until it is done).'''
+        if threading.current_thread() is getattr(self, 'io_thread', None):
+            return self.transact(msg, debug)
+        return self.submit(msg, debug, priority, timeout).result()
+    def process_requests(self):
+        '''Send the queued commands one by one (run by the I/O thread).
+
+        While the Arduino is reconnecting the commands stay in the queue (until
+        their timeout). A command interrupted by a lost connection is queued again.'''
+        while True:
+            request = self.requests.get()
+            priority, __, submitted, deadline, msg, debug, future = request
+            if not future.running() and not future.set_running_or_notify_cancel():
+                continue
+            if time.monotonic() > deadline:
+                future.set_exception(ComProtocolError('Command timed out in the queue: %s'%msg))
+                continue
+            if not self.connected.is_set():
+                self.requests.put(request)
+                self.connected.wait(0.5)
+                self.expire_requests()
+                continue
+            try:
+                future.set_result(self.transact(msg, debug))
+            except (ConnectionLost, serial.SerialException, OSError) as e:
+                logger.info('Lost the Arduino connection (%s). Reconnecting...', e)
+                self.requests.put(request)
+                self.start_reconnect()
+                continue
+            except Exception as e:
+                future.set_exception(e)
+            latency = time.monotonic()-submitted
+            histogram = self.latencies[msg.split(b' ')[0].decode()]
+            histogram[bisect.bisect_left(self.latency_bins, latency)] += 1
+    def expire_requests(self):
+        '''Fail all queued commands past their timeout (not just the first one) and drop the cancelled ones.'''
+        pending = []
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            deadline, msg, future = request[3], request[4], request[-1]
+            if time.monotonic() > deadline:
+                if future.running() or future.set_running_or_notify_cancel():
+                    future.set_exception(ComProtocolError('Command timed out in the queue: %s'%msg))
+            elif not future.cancelled():
+                pending.append(request)
+        for request in pending:
+            self.requests.put(request)
+    def report(self):
+        '''A short description of the command queue, the latency histograms and the resets.'''
+        lines = ['SerialIO: %d queued, %s, %d resets, %.0fs downtime'%(
+                 self.requests.qsize(), 'connected' if self.connected.is_set() else 'reconnecting',
+                 self.resets, self.downtime)]
+        lines.extend('%s: %s'%(command, ' '.join('<%gs:%d'%(b, c) for b, c in zip(self.latency_bins, histogram) if c))
+                     for command, histogram in sorted(self.latencies.items()))
+        return '\n    '.join(lines)
+    def connect(self):
+        '''Open the serial port and negotiate the fastest protocol supported by the Arduino.'''
+        self.protocol = 'ascii'
+        self.serial = serial.Serial(port=self.port, baudrate=self.baudrate, timeout=4)
         time.sleep(2)
-        self.lock = threading.Lock()
+        if self.try_binary:
+            self.negotiate()
+    def negotiate(self):
+        '''Switch to the binary protocol if the Arduino supports it.'''
+        try:
+            version, max_baudrate = self.transact(b'protocolVersion', debug=False)
+        except ComProtocolError:
+            logger.info('The Arduino does not support the binary protocol. Staying with ASCII.')
+            return
+        if version < self.protocol_version:
+            logger.info('The Arduino supports protocol version %d only. Staying with ASCII.', version)
+            return
+        baudrate = min(self.fast_baudrate, max_baudrate)
+        self.transact(('switchProtocol %d'%baudrate).encode(), debug=False)
+        self.serial.baudrate = baudrate
+        self.protocol = 'binary'
+        time.sleep(0.1)
+        try:
+            self.transact(b'checkHeartBeat', debug=False)
+            logger.info('Switched to the binary protocol at %d baud.', baudrate)
+        except ComProtocolError:
+            logger.info('The binary protocol failed. Resetting to ASCII...')
+            self.try_binary = False
+            self.reset()
     def reset(self):
+        '''Reset the USB device of the Arduino and connect again (finding its possibly renumbered port).'''
         self.serial.close()
+        self.resets += 1
+        device = usb_device(find_port(self.serial_number) or self.port)
+        busnum, devnum = read_sysfs(device, 'busnum'), read_sysfs(device, 'devnum')
+        if busnum is None or devnum is None:
+            raise ConnectionLost('The Arduino USB device is not present.')
         pwd = os.path.dirname(os.path.realpath(__file__))
         usbreset_file = os.path.join(pwd, 'usbreset')
-        for line in subprocess.check_output(['lsusb']).split(b'\n'):
-            if b'Arduino' in line:
-                bus, dev = line.split(b':')[0].split(b' ')[1::2]
-                bus = bus.decode('utf8')
-                dev = dev.decode('utf8')
-                break
-        subprocess.check_output(['sudo', usbreset_file, '/dev/bus/usb/%s/%s'%(bus,dev)])
-        self.serial = serial.Serial(port=self.port, baudrate=9600, timeout=4)
-        time.sleep(2)
-    def send(self, msg, debug=True):
-        msg += ('#%X'%binascii.crc32(msg)).encode()
-        with self.lock:
-            count = 0
-            while count<5:
-                buf = self.serial.read_all()
-                if buf.endswith(b'\r\nready\r\n\x04'):
-                    logger.info('The Arduino was reset.')
-                    if debug:
-                        print('reset has happened')
-                elif buf:
-                    raise ComProtocolError('Buffer not clean.')
-                self.serial.write(msg + b'\r')
-                echo = self.serial.read_until(b'\x04') # ascii EOT
-                ret =  self.serial.read_until(b'\x04') # ascii EOT
-                expected = msg + b'\r\r\n' + msg + b'\r\n\x04'
-                if debug:
-                    print('out     : ',msg)
-                    print('expected: ',expected)
-                    print('echo    : ',echo)
-                    print('return  : ',ret)
-                if echo == expected:
+        subprocess.check_output(['sudo', usbreset_file, '/dev/bus/usb/%03d/%03d'%(int(busnum), int(devnum))])
+        time.sleep(1) # Give the device time to be enumerated again.
+        self.port = find_port(self.serial_number) or self.port
+        self.connect()
+    def start_reconnect(self):
+        '''Reset and reconnect the Arduino in a separate thread (with exponential backoff between attempts).'''
+        if self.reconnect_thread is not None and self.reconnect_thread.is_alive():
+            return
+        self.connected.clear()
+        def target():
+            start = time.monotonic()
+            backoff = 1
+            for attempt in itertools.count(1):
+                try:
+                    self.reset()
                     break
-                logger.info('The Arduino connection produced garbled echo. Resetting USB and retrying...')
-                count += 1
-                with db:
-                    db.execute('''INSERT INTO communication_log
-                                  (note ) VALUES (? )''',
-                        ('reset %d on msg="%s" expected="%s" echo="%s" return="%s"'%(count, msg, expected, echo, ret),))
-                self.reset()
+                except Exception as e: # Whatever happens, keep trying (the commands wait for `connected`).
+                    logger.info('Reconnection attempt %d failed (%s). Retrying in %ds...', attempt, e, backoff)
+                    time.sleep(backoff)
+                    backoff = min(2*backoff, self.max_backoff)
+            downtime = time.monotonic()-start
+            self.downtime += downtime
+            logger.info('Reconnected to the Arduino on %s.', self.port)
+            self.connected.set()
+            writer.insert('communication_log',
+                          note='reconnected on %s after %d attempts and %.1fs downtime (%d resets in total)'%(
+                               self.port, attempt, downtime, self.resets))
+        self.reconnect_thread = threading.Thread(target=target, name='SerialReconnect')
+        self.reconnect_thread.start()
+    def transact(self, msg, debug=True):
+        '''Do the round trip for a command and return the list of returned numbers. Raise `ConnectionLost` on garbled communication.'''
+        with self.lock:
+            if self.protocol == 'binary':
+                ret, log = self.send_binary(msg, debug)
             else:
-                raise ComProtocolError('Repeated garbled echo!')
-            if ret == b'\r\n-\r\n\x04':
-                raise ComProtocolError('Arduino error!')
-            ret, crc = ret[2:-3].split(b'#')
-            if int(crc,16) != binascii.crc32(ret):
-                raise ComProtocolError('Incorrect checksum!')
-        return [float(_) if b'.' in _ else int(_) for _ in ret.split(b' ')]
+                ret, log = self.send_ascii(msg, debug)
+            if ret is None:
+                logger.info('The Arduino connection produced garbled data.')
+                writer.insert('communication_log', note='garbled on %s'%log)
+                raise ConnectionLost('Garbled communication.')
+            return ret
+    def send_ascii(self, msg, debug=True):
+        '''Try sending a command with the ASCII protocol. Return the result (None if garbled) and a log message.'''
+        msg += ('#%X'%binascii.crc32(msg)).encode()
+        buf = self.serial.read_all()
+        if buf.endswith(b'\r\nready\r\n\x04'):
+            logger.info('The Arduino was reset.')
+            if debug:
+                print('reset has happened')
+        elif buf:
+            raise ComProtocolError('Buffer not clean.')
+        self.serial.write(msg + b'\r')
+        echo = self.serial.read_until(b'\x04') # ascii EOT
+        ret =  self.serial.read_until(b'\x04') # ascii EOT
+        expected = msg + b'\r\r\n' + msg + b'\r\n\x04'
+        if debug:
+            print('out     : ',msg)
+            print('expected: ',expected)
+            print('echo    : ',echo)
+            print('return  : ',ret)
+        if echo != expected:
+            return None, 'msg="%s" expected="%s" echo="%s" return="%s"'%(msg, expected, echo, ret)
+        if ret == b'\r\n-\r\n\x04':
+            raise ComProtocolError('Arduino error!')
+        ret, crc = ret[2:-3].split(b'#')
+        if int(crc,16) != binascii.crc32(ret):
+            raise ComProtocolError('Incorrect checksum!')
+        return [float(_) if b'.' in _ else int(_) for _ in ret.split(b' ')], ''
+    def send_binary(self, msg, debug=True):
+        '''Try sending a command with the binary protocol. Return the result (None if garbled) and a log message.'''
+        self.serial.reset_input_buffer()
+        self.serial.write(b'\x02' + bytes([len(msg)]) + msg + struct.pack('<I', binascii.crc32(msg)))
+        header = self.serial.read(2)
+        payload = self.serial.read(header[1]) if len(header) == 2 else b''
+        crc = self.serial.read(4)
+        if debug:
+            print('out     : ',msg)
+            print('return  : ',header+payload+crc)
+        if (len(header) != 2 or header[0] != 2 or len(payload) != header[1] or len(crc) != 4
+            or struct.unpack('<I', crc)[0] != binascii.crc32(payload)):
+            return None, 'msg="%s" return="%s"'%(msg, header+payload+crc)
+        if payload[0]:
+            raise ComProtocolError('Arduino error!')
+        ret = []
+        for i in range(1, len(payload), 5):
+            ret.append(struct.unpack('<f' if payload[i:i+1] == b'f' else '<i', payload[i+1:i+5])[0])
+        return ret, ''
 
 
 class Reactor(SerialManager):
@@ -82,32 +303,32 @@ class Reactor(SerialManager):
     def __init__(self, port):
         super().__init__(port)
 
+    # The stepper moves 10 steps (one increment of the move commands) in about
+    # 75ms. Each command has to finish before the serial timeout, hence long
+    # moves are split in chunks.
+    seconds_per_step = 0.075
+
+    def max_steps_per_command(self):
+        '''The number of increments that can be safely done in a single command.'''
+        return int(0.75*self.serial.timeout/self.seconds_per_step)
+
     def move_head_steps(self, steps_x, steps_y):
         '''Move the head the given amount of steps.'''
-        # XXX It divides the move in repeated small movements, because
-        # movement is slow and it might timeout the serial connection.
-        while steps_x > 0:
-            self.send(b'moveStepper x +')
-            steps_x -= 1
-        while steps_x < 0:
-            self.send(b'moveStepper x -')
-            steps_x += 1
-        while steps_y > 0:
-            self.send(b'moveStepper y +')
-            steps_y -= 1
-        while steps_y < 0:
-            self.send(b'moveStepper y -')
-            steps_y += 1
+        max_steps = self.max_steps_per_command()
+        while steps_x or steps_y:
+            chunk_x = max(-max_steps, min(max_steps, steps_x))
+            max_steps_y = max_steps - abs(chunk_x)
+            chunk_y = max(-max_steps_y, min(max_steps_y, steps_y))
+            self.send(('moveSteppers %d %d'%(chunk_x, chunk_y)).encode())
+            steps_x -= chunk_x
+            steps_y -= chunk_y
 
     def move_head_to_origin(self):
         '''Move head to origin.
 
-        First move in the x, then move in y.'''
-        while self.send(b'checkOrigin')[0]:
-            self.move_head_steps(-1, 0)
-
-        while self.send(b'checkOrigin')[1]:
-            self.move_head_steps(0, -1)
+        First move in the x, then move in y (done by the Arduino in chunks).'''
+        while any(self.send(('homeSteppers %d'%self.max_steps_per_command()).encode())):
+            pass
 
     def move_head_to_well(self, row, col, instrument_offset):
         '''Move the head to the given well, taking into account the instrument offset.'''
@@ -174,14 +395,11 @@ class Reactor(SerialManager):
                 control = min(+1., control)
                 control = max(-1., control)
                 self.set_heat_flow(control)
-                with db:
-                    db.execute('''INSERT INTO temperature_control_log
-                                  (target_temp, error,
-                                  proportional, integral)
-                                  VALUES (?,?,?,?)''',
-                                  (self._target_temp, error, P, I))
+                writer.insert('temperature_control_log',
+                              target_temp=self._target_temp, error=error,
+                              proportional=P, integral=I)
                 print('\r',(self._target_temp, error, P, I, control), flush=True)
-                time.sleep(10)
+                clock.sleep(10)
         self._temp_thread = threading.Thread(target=temp_control, name='TemperatureControl')
         self._temp_thread.start()
 
@@ -197,17 +415,184 @@ class Reactor(SerialManager):
         ...
 
 
-class MockReactor:
-    '''A mock reactor class for dev and testing.'''
-    def __getattr__(self, name):
-        def mock_function(*args):
-            import time
-            time.sleep(3)
-            return np.random.random((4,5))*2-1
-        return mock_function
+###############################################################################
+# Simulated reactor running on a (possibly accelerated) virtual clock.
+###############################################################################
+
+class VirtualClock:
+    '''A monotonic clock running `speed` times faster than real time.
+
+    `time` and `sleep` replace `time.monotonic` and `time.sleep`, and `utcnow`
+    gives the matching (virtual) wall clock time used for timestamps.'''
+    def __init__(self, speed=1):
+        self.speed = speed
+        self.real_start = time.monotonic()
+        self.utc_start = datetime.datetime.utcnow()
+    def time(self):
+        return self.real_start + self.speed*(time.monotonic()-self.real_start)
+    def sleep(self, seconds):
+        time.sleep(seconds/self.speed)
+    def utcnow(self):
+        return self.utc_start + datetime.timedelta(seconds=self.time()-self.real_start)
+
+class SimulatedReactor(Reactor):
+    '''A physics-lite simulation of the reactor for dev and load testing.
+
+    The wells follow logistic growth (depending on temperature and light),
+    evaporate, and are diluted by the pumps. The block temperature follows a
+    first order model driven by the heat flow of the temperature control loop.
+    Pumps and head moves take (virtual) time as on the hardware.'''
+    rows, cols = 4, 5
+    nominal_volume = 10. # ml in a full well
+    inoculum = 0.05 # optical density after filling with media
+    capacity = 2. # maximal optical density
+    max_growth_rate = 1/3600. # per second, at the optimal temperature and saturating light
+    optimal_temp = 37.
+    temp_tolerance = 8. # width (in C) of the growth rate bell curve around the optimal temperature
+    half_saturation_light = 50. # uE/m2/s
+    evaporation_rate = 1/86400. # ml per second
+    ambient_temp = 22.
+    thermal_time_constant = 600. # seconds
+    max_heating = 30. # C above ambient at full heat flow (at equilibrium)
+    gradient = 0.5 # C between consecutive rows
+    pump_rate = 1. # ml per second
+    seconds_per_well = 0.5 # head move and measurement
+    noise = 0.01 # relative measurement noise
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.random = np.random.RandomState(0)
+        self.last = clock.time()
+        self.biomass = np.zeros((self.rows, self.cols))
+        self.volume = np.zeros((self.rows, self.cols))
+        self.temp = self.ambient_temp
+        self.heat_flow = 0.
+        self.light = 0.
+        self._target_temp = self.ambient_temp
+
+    def report(self):
+        '''A short description of the simulated state.'''
+        with self.lock:
+            self.advance()
+            return 'SimulatedReactor: x%g, %.1fC, mean OD %.3f, mean volume %.2fml'%(
+                   self.clock.speed, self.temp, self.biomass.mean(), self.volume.mean())
+
+    def advance(self):
+        '''Integrate the state up to the current (virtual) time.'''
+        now = self.clock.time()
+        dt, self.last = now-self.last, now
+        # Temperature: exponential approach to the equilibrium for the current heat flow.
+        equilibrium = self.ambient_temp + self.max_heating*self.heat_flow
+        self.temp = equilibrium + (self.temp-equilibrium)*np.exp(-dt/self.thermal_time_constant)
+        # Growth: exact solution of the logistic equation over the step.
+        rate = (self.max_growth_rate
+                *np.exp(-((self.well_temps()-self.optimal_temp)/self.temp_tolerance)**2)
+                *self.light/(self.light+self.half_saturation_light))
+        growing = self.biomass > 0
+        growth = np.exp(rate*dt)
+        self.biomass[growing] = (self.capacity*self.biomass*growth
+                                 /(self.capacity+self.biomass*(growth-1)))[growing]
+        # Evaporation concentrates the wells.
+        evaporated = np.minimum(self.volume, self.evaporation_rate*dt)
+        left = self.volume-evaporated
+        self.biomass[left > 0] *= (self.volume/np.where(left > 0, left, 1))[left > 0]
+        self.volume = left
+
+    def well_temps(self):
+        '''The temperature of each well (linear gradient across the rows).'''
+        rows = (np.arange(self.rows)-(self.rows-1)/2)*self.gradient
+        return np.repeat((self.temp+rows)[:,None], self.cols, axis=1)
+
+    def measured(self, data):
+        return data*(1+self.noise*self.random.standard_normal(np.shape(data)))
+
+    def pump(self, volumes):
+        '''Take the time needed to pump the given volumes (one well after the other).'''
+        self.clock.sleep(np.abs(volumes).sum()/self.pump_rate)
+
+    def add_liquid(self, volumes, media):
+        '''Add liquid to the wells (diluting them) and return the added volumes.'''
+        self.pump(volumes)
+        with self.lock:
+            self.advance()
+            total = self.volume+volumes
+            filled = total > 0
+            self.biomass[filled] *= (self.volume/np.where(filled, total, 1))[filled]
+            if media:
+                self.biomass[self.volume == 0] = self.inoculum
+            self.volume = total
+        return volumes
+
+    def temps(self):
+        with self.lock:
+            self.advance()
+            temps = self.well_temps()[:,0]
+        # Two sensors per pair of rows, as on the hardware.
+        return list(self.measured(np.array([temps[0], temps[1], temps[1], temps[2], temps[2], temps[3]])))
+
+    def set_heat_flow(self, heat_flow):
+        assert -1 <= heat_flow <= +1, 'Heat flow is out of range.'
+        with self.lock:
+            self.advance()
+            self.heat_flow = heat_flow
+
+    def set_light_input(self, intensity):
+        with self.lock:
+            self.advance()
+            self.light = intensity
+
+    def light_input_array(self):
+        self.clock.sleep(self.seconds_per_well*self.rows*self.cols)
+        return self.measured(np.ones((self.rows, self.cols))*self.light)
+
+    def light_out_array(self):
+        self.clock.sleep(self.seconds_per_well*self.rows*self.cols)
+        with self.lock:
+            self.advance()
+            return self.measured(self.light*10**-self.biomass)
+
+    def temp_array(self):
+        with self.lock:
+            self.advance()
+            return self.measured(self.well_temps())
+
+    def fill_with_media(self):
+        self.fill_with_media_array()
+
+    def fill_with_media_array(self):
+        '''Fill the wells up to the nominal volume with media and return the added volumes.'''
+        with self.lock:
+            self.advance()
+            missing = self.nominal_volume-self.volume
+        return self.add_liquid(missing, media=True)
+
+    def fill_with_water(self):
+        '''Compensate the evaporation with water and return the added volumes.'''
+        with self.lock:
+            self.advance()
+            missing = self.nominal_volume-self.volume
+        return self.add_liquid(missing, media=False)
+
+    def drain_well(self, volume):
+        '''Drain the given volume (ml) from every well.'''
+        with self.lock:
+            self.advance()
+            drained = np.minimum(self.volume, volume)
+        self.pump(drained)
+        with self.lock:
+            self.advance()
+            self.volume = np.maximum(self.volume-drained, 0)
+
+    def pause(self):
+        pass
+
 
+# The clock of the scheduler. The simulated reactor can run it faster than
+# real time (BIOREACTOR_SPEED=1000 replays a day in about a minute and a half).
+clock = VirtualClock()
 
-# Try to connect to the Arduino. If it is not available start a mock reactor.
+# Try to connect to the Arduino. If it is not available start a simulated reactor.
 for serial_file in glob.glob('/dev/ttyACM*'):
     logger.info('Attempting Arduino connection on %s...'%serial_file)
     if True:
@@ -215,5 +600,7 @@ for serial_file in glob.glob('/dev/ttyACM*'):
         logger.info('Connected to Arduino on %s.'%serial_file)
         break
 else:
-    logger.info('No Arduino detected! Set a mock reactor.')
-    reactor = MockReactor()
+    clock.speed = float(os.environ.get('BIOREACTOR_SPEED', 1))
+    logger.info('No Arduino detected! Set a simulated reactor (x%g speed).', clock.speed)
+    reactor = SimulatedReactor(clock)
+    writer.now = clock.utcnow
@@ -1,3 +1,4 @@
+import concurrent.futures
 import heapq
 import logging
 import sched
@@ -8,8 +9,9 @@ import pytimeparse
 
 import numpy as np
 
-from reactor import reactor
-from database import db
+import database
+from reactor import reactor, clock
+from database import writer, summary_statements
 
 logger = logging.getLogger('scheduler')
 
@@ -18,63 +20,132 @@ logger = logging.getLogger('scheduler')
 # Prepare scheduler.
 ###############################################################################
 
+# The hardware resources (lanes) used by events. Events using different
+# resources can run concurrently.
+lanes = frozenset(['head', 'pumps', 'sensors'])
+
 class ResolvedScheduler(sched.scheduler):
-    '''Scheduler where new events can be added for execution at any time.'''
-    def __init__(self, *args, resolution=1, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.resolution = resolution
-        self.current = None
+    '''Scheduler where new events can be added for execution at any time.
+
+    `run` sleeps until the next deadline and is woken up immediately when an
+    event is entered, cancelled, or finished (from any thread). Due events are
+    executed on a pool of workers, as soon as none of the `resources` they
+    declare (all `lanes` by default) is used by a running event.
+
+    `speed` is the rate of `timefunc` relative to real time (for virtual clocks).
+    The `listeners` are called (holding the scheduler lock) on every change.'''
+    def __init__(self, timefunc=time.monotonic, delayfunc=time.sleep, speed=1):
+        super().__init__(timefunc, delayfunc)
+        self.speed = speed
+        self.changed = threading.Condition(self._lock)
+        self.stopping = threading.Event()
+        self.running = []
+        self.busy = set()
+        self.listeners = []
+        self.stats = {lane: {'runs': 0, 'last delay': 0., 'mean delay': 0., 'max delay': 0., 'drift': 0.}
+                      for lane in lanes}
+    def enterabs(self, *args, **kwargs):
+        with self.changed:
+            event = super().enterabs(*args, **kwargs)
+            self.notify()
+        return event
+    def cancel(self, event):
+        with self.changed:
+            super().cancel(event)
+            self.notify()
+    def notify(self):
+        '''Wake up `run` and call the listeners (holding the lock).'''
+        self.changed.notify_all()
+        for listener in self.listeners:
+            listener()
+    def stop(self):
+        '''Make `run` return (after the currently running events finish).'''
+        with self.changed:
+            self.stopping.set()
+            self.changed.notify_all()
+    def execute(self, event, resources):
+        '''Run an event on a worker and release its resources afterwards.'''
+        delay = self.timefunc()-event.time
+        try:
+            event.action(*event.argument, **event.kwargs)
+        except Exception:
+            logger.exception('Event %s failed.', type(event.action).__name__)
+        finally:
+            with self.changed:
+                self.running.remove(event)
+                self.busy -= resources
+                for lane in resources:
+                    stats = self.stats[lane]
+                    stats['runs'] += 1
+                    stats['last delay'] = delay
+                    stats['mean delay'] += (delay-stats['mean delay'])/stats['runs']
+                    stats['max delay'] = max(stats['max delay'], delay)
+                    stats['drift'] += delay # accumulated lateness of the lane
+                self.notify()
     def run(self, blocking=True):
-        # Based on the python3.5 source code.
-        lock = self._lock
+        '''Run the events when they are due (and their resources are free).
+
+        If blocking, wait for new events until `stop` is called. Otherwise
+        return the time until the next event (None if the queue is empty).'''
         q = self._queue
-        delayfunc = self.delayfunc
         timefunc = self.timefunc
-        pop = heapq.heappop
-        while True:
-            with lock:
-                if not q:
-                    break
-                time, priority, action, argument, kwargs = current = q[0]
-                now = timefunc()
-                if time > now:
-                    delay = True
-                else:
-                    delay = False
-                    pop(q)
-            if delay:
-                if not blocking:
-                    return time - now
-                delayfunc(self.resolution)
-                continue
-            else:
-                self.current = current
-                action(*argument, **kwargs)
-                self.current = None
-                delayfunc(0)
-
-reactor_scheduler = ResolvedScheduler()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(lanes))
+        try:
+            while not self.stopping.is_set():
+                with self.changed:
+                    now = timefunc()
+                    runnable = None
+                    reserved = set() # Resources waited for by earlier events (so they do not starve).
+                    for event in sorted(q):
+                        if event.time > now:
+                            break
+                        resources = getattr(event.action, 'resources', lanes)
+                        if not (resources & (self.busy | reserved)):
+                            runnable = event
+                            break
+                        reserved |= resources
+                    if runnable is None:
+                        upcoming = [_.time for _ in q if _.time > now]
+                        if not blocking:
+                            return min(upcoming)-now if upcoming else None
+                        self.changed.wait((min(upcoming)-now)/self.speed if upcoming else None)
+                        continue
+                    q.remove(runnable)
+                    heapq.heapify(q)
+                    resources = frozenset(resources)
+                    self.busy |= resources
+                    self.running.append(runnable)
+                    self.notify()
+                executor.submit(self.execute, runnable, resources)
+        finally:
+            executor.shutdown(wait=True)
+
+reactor_scheduler = ResolvedScheduler(clock.time, clock.sleep, clock.speed)
 current_experiment = None
+database.running_experiment = lambda: current_experiment
 
-stop_thread = threading.Event()
+scheduler_thread = None
 def start_scheduler_thread():
     '''Start the scheduler in a dedicated thread. Return thread handler.'''
+    global scheduler_thread
     def target():
-        '''Continuously run the scheduler. If the queue is empty, wait a second and rerun.'''
+        '''Run the scheduler until it is stopped.'''
         logger.info('Starting the scheduler...')
-        while not stop_thread.is_set():
-            reactor_scheduler.run()
-            time.sleep(1)
+        reactor_scheduler.run()
         logger.info('The scheduler has stopped.')
-    t = threading.Thread(target=target,
-                         name='Scheduler')
-    t.start()
-    return t
+    writer.start()
+    scheduler_thread = threading.Thread(target=target,
+                                        name='Scheduler')
+    scheduler_thread.start()
+    return scheduler_thread
 
 def stop_scheduler_thread():
-    '''Stop the scheduler thread.'''
+    '''Stop the scheduler thread (waiting for running events) and flush the buffered measurements.'''
     logger.info('Stopping the scheduler...')
-    stop_thread.set()
+    reactor_scheduler.stop()
+    if scheduler_thread is not None:
+        scheduler_thread.join()
+    writer.stop()
 
 
 ###############################################################################
@@ -83,18 +154,67 @@ def stop_scheduler_thread():
 
 # XXX All `__init__` arguments are permitted to be strings!
 
+def record(table, data):
+    '''Queue a measurement of the current experiment, together with the updates of its summaries.'''
+    timestamp = writer.now()
+    writer.insert(table, statements=summary_statements(current_experiment, table, timestamp, data),
+                  experiment_name=current_experiment, data=data, timestamp=timestamp)
+
 class Event:
-    pass
+    resources = lanes # The lanes needed by the event (all of them, unless specified).
 
 class RepeatedEvent(Event):
-    def __init__(self, delay='1min'):
+    '''An event running on a fixed grid of deadlines, `delay` apart, starting from its first run.
+
+    If a run ends after the next deadline the `overrun` policy applies:
+    `skip` the missed deadlines, `coalesce` them in a single immediate run, or
+    `catchup` by running once for each of them. Missed and late deadlines are
+    counted and logged in the `deadline_log` table.'''
+    overrun_policies = ['skip', 'coalesce', 'catchup']
+    tolerance = 1 # Seconds after the deadline before a run is considered late.
+    def __init__(self, delay='1min', overrun='skip'):
         try:
             secs = float(delay)*60
         except ValueError:
             secs = pytimeparse.parse(delay)
         if secs is None:
             raise ValueError('Could not convert string "%s" to time.'%delay)
+        if overrun not in self.overrun_policies:
+            raise ValueError('Overrun policy should be one of %s.'%', '.join(self.overrun_policies))
         self.delay = secs
+        self.overrun = overrun
+        self.deadline = None
+        self.missed = 0
+        self.late = 0
+
+    def __call__(self):
+        now = reactor_scheduler.timefunc()
+        if self.deadline is None:
+            self.deadline = now
+        lateness = now-self.deadline
+        if lateness > self.tolerance:
+            self.late += 1
+        try:
+            self.run()
+        finally: # A failed run (logged by the scheduler) does not remove the event from the schedule.
+            self.reschedule(lateness)
+
+    def reschedule(self, lateness):
+        '''Enter the next run on the grid of deadlines, according to the overrun policy.'''
+        now = reactor_scheduler.timefunc()
+        self.deadline += self.delay
+        missed = 0
+        if now > self.deadline and self.overrun != 'catchup':
+            missed = int((now-self.deadline)//self.delay) # deadlines passed before the next one
+            self.deadline += missed*self.delay
+            if self.overrun == 'skip':
+                missed += 1
+                self.deadline += self.delay
+        self.missed += missed
+        if missed or lateness > self.tolerance:
+            writer.insert('deadline_log', experiment_name=current_experiment,
+                          event=type(self).__name__, lateness=lateness, missed=missed)
+        reactor_scheduler.enterabs(self.deadline,0,self)
 
 class StartExperiment(Event):
     def __init__(self, name, light, temp, strain, description,
@@ -111,76 +231,59 @@ class StartExperiment(Event):
         logger.info('Experiment %s starting...', current_experiment)
         reactor.fill_with_media()
         reactor.set_target_temp(self.temp)
-        with db:
-            reactor.set_light_input(self.light)
-            light_in_data = reactor.light_input_array()
-            db.execute('''INSERT INTO light_in__uEm2s (experiment_name, data)
-                          VALUES (?, ?)''',
-                         (current_experiment, light_in_data))
+        reactor.set_light_input(self.light)
+        light_in_data = reactor.light_input_array()
+        record('light_in__uEm2s', light_in_data)
         reactor.pause()
 
 class MeasureTemp(RepeatedEvent):
     '''Periodically measure the temperature of the wells.'''
-    def __call__(self):
+    resources = frozenset(['sensors'])
+    def run(self):
         data = reactor.temp_array()
-        with db:
-            db.execute('''INSERT INTO temperature__C (experiment_name, data)
-                          VALUES (?, ?)''',
-                         (current_experiment, data))
+        record('temperature__C', data)
         logger.info('%s %s', type(self).__name__, data.mean())
-        reactor_scheduler.enter(self.delay,0,self)
 
 class MeasureLightOut(RepeatedEvent):
     '''Periodically measure the light coming out of the wells.'''
-    def __call__(self):
+    resources = frozenset(['head'])
+    def run(self):
         data = reactor.light_out_array()
-        with db:
-            db.execute('''INSERT INTO light_out__uEm2s (experiment_name, data)
-                          VALUES (?, ?)''',
-                         (current_experiment, data))
+        record('light_out__uEm2s', data)
         logger.info('%s %s', type(self).__name__, data.mean())
-        reactor_scheduler.enter(self.delay,0,self)
 
 class WaterFill(RepeatedEvent):
     '''Periodically fill up with water (for evaporative losses).'''
-    def __call__(self):
+    resources = frozenset(['pumps'])
+    def run(self):
         data = reactor.fill_with_water()
-        with db:
-            db.execute('''INSERT INTO water__ml (experiment_name, data)
-                          VALUES (?, ?)''',
-                         (current_experiment, data))
+        record('water__ml', data)
         logger.info('%s %s', type(self).__name__, data.mean())
-        reactor_scheduler.enter(self.delay,0,self)
 
 class DrainFill(RepeatedEvent):
     '''Periodically drain and refill with media.'''
-    def __init__(self, delay="1min", drain_volume="1"):
-        super().__init__(delay)
+    resources = frozenset(['pumps'])
+    def __init__(self, delay="1min", overrun="skip", drain_volume="1"):
+        super().__init__(delay, overrun)
         self.drain_volume = float(drain_volume)
 
-    def __call__(self):
+    def run(self):
         reactor.drain_well(self.drain_volume)
-        drained_data = np.array([[self.drain_volume]*4]*5)
+        drained_data = np.ones((4,5))*self.drain_volume
         media_data = reactor.fill_with_media_array()
-        with db:
-            db.execute('''INSERT INTO drained__ml (experiment_name, data)
-                          VALUES (?, ?)''',
-                         (current_experiment, drained_data))
-            db.execute('''INSERT INTO media__ml (experiment_name, data)
-                          VALUES (?, ?)''',
-                         (current_experiment, media_data))
-        logger.info('%s: drain %s, media fill %s', type(self).__name__, 'drain', drained_data.mean(), 'media fill', media_data.mean())
-        reactor_scheduler.enter(self.delay,0,self)
+        record('drained__ml', drained_data)
+        record('media__ml', media_data)
+        logger.info('%s: drain %s, media fill %s', type(self).__name__, drained_data.mean(), media_data.mean())
 
 class StopExperiment(Event):
     def __call__(self):
         global current_experiment
         logger.info('Experiment %s ending...', current_experiment)
-        # TODO Not thread safe!
-        for event in s.queue:
-            s.cancel(event)
+        for event in reactor_scheduler.queue:
+            reactor_scheduler.cancel(event)
         current_experiment = None
         logger.info('Experiment %s ended.', current_experiment)
 
 # Events that autopopulate the new experiment web page.
 events = [MeasureTemp, MeasureLightOut, WaterFill, DrainFill]
+
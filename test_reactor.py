@@ -0,0 +1,300 @@
+'''Tests of the serial protocols of `reactor.SerialManager` against a fake Arduino on a pseudo-terminal.
+
+Run with `python -m unittest test_reactor`.'''
+import binascii
+import datetime
+import os
+import pty
+import select
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import database
+import reactor
+
+
+class FakeReset(Exception):
+    pass
+
+class FakeArduino(threading.Thread):
+    '''The serial side of `arduino_protocol.ino`, on the master side of a pseudo-terminal.
+
+    It starts with the ASCII protocol (with echo) and, if `protocol_version`
+    is given, supports `protocolVersion` and `switchProtocol` to the binary
+    protocol. `reset` brings it back to ASCII, as a USB reset does. The
+    commands received are recorded in `commands` as `(protocol, command)`.'''
+    temperatures = '23.50 24.00 24.50 25.00 25.50 26.00'
+
+    def __init__(self, protocol_version=2, max_baudrate=115200, broken_binary=False):
+        super().__init__(name='FakeArduino', daemon=True)
+        self.master, self.slave = pty.openpty() # The slave stays open, so the master never sees a hangup.
+        self.port = os.ttyname(self.slave)
+        self.protocol_version = protocol_version
+        self.max_baudrate = max_baudrate
+        self.broken_binary = broken_binary # Garble all binary replies (e.g. a bad cable at high speed).
+        self.binary = False
+        self.garble = 0 # The number of next replies to garble.
+        self.commands = []
+        self.stopped = threading.Event()
+        self.resetting = threading.Event()
+        self.ready = threading.Event()
+        self.start()
+
+    def close(self):
+        self.stopped.set()
+        self.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def reset(self):
+        '''Restart the sketch (whatever it is doing) and wait for it to be ready.'''
+        self.resetting.set()
+        self.ready.wait()
+        self.ready.clear()
+
+    def read(self):
+        while not self.stopped.is_set():
+            if self.resetting.is_set():
+                raise FakeReset
+            if select.select([self.master], [], [], 0.05)[0]:
+                return os.read(self.master, 1)
+        raise EOFError
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def run(self):
+        while True:
+            try:
+                if self.binary:
+                    self.loop_binary()
+                else:
+                    self.loop_ascii()
+            except EOFError:
+                return
+            except FakeReset:
+                while select.select([self.master], [], [], 0)[0]: # The input is lost.
+                    os.read(self.master, 1024)
+                self.binary = False
+                self.write(b'\r\nready\r\n\x04')
+                self.resetting.clear()
+                self.ready.set()
+
+    def loop_ascii(self):
+        line = b''
+        while not line.endswith(b'\r'):
+            line += self.read()
+        self.write(line) # The echo.
+        command, __, crc = line[:-1].partition(b'#')
+        if self.garble:
+            self.garble -= 1
+            self.write(b'garbled\x04garbled\x04')
+            return
+        if crc and int(crc, 16) != binascii.crc32(command):
+            self.reply_ascii(None)
+            return
+        self.reply_ascii(command) # The echo of the parsed command.
+        self.commands.append(('ascii', command.decode()))
+        self.reply_ascii(self.execute(command.decode()))
+        if command.startswith(b'switchProtocol') and self.protocol_version:
+            self.binary = True
+
+    def reply_ascii(self, ret):
+        if ret is None:
+            self.write(b'\r\n-\r\n\x04')
+        else:
+            self.write(b'\r\n'+ret+('#%X\r\n\x04'%binascii.crc32(ret)).encode())
+
+    def loop_binary(self):
+        while self.read() != b'\x02':
+            pass
+        length = self.read()[0]
+        payload = b''.join(self.read() for _ in range(length))
+        crc = struct.unpack('<I', b''.join(self.read() for _ in range(4)))[0]
+        if crc != binascii.crc32(payload):
+            self.reply_binary(None)
+            return
+        self.commands.append(('binary', payload.decode()))
+        if self.garble or self.broken_binary:
+            self.garble = max(self.garble-1, 0)
+            self.write(b'\x02\x01\x00\x00\x00\x00\x00')
+            return
+        ret = self.execute(payload.decode())
+        self.reply_binary(None if ret is None else ret.decode())
+
+    def reply_binary(self, ret):
+        payload = b'\x01' if ret is None else b'\x00'
+        for token in (ret or '').split():
+            payload += b'f'+struct.pack('<f', float(token)) if '.' in token else b'i'+struct.pack('<i', int(token))
+        self.write(b'\x02'+bytes([len(payload)])+payload+struct.pack('<I', binascii.crc32(payload)))
+
+    def execute(self, command):
+        '''Return the reply of a command (None for an error).'''
+        name, __, argument = command.partition(' ')
+        if name == 'checkHeartBeat':
+            return b'1234 512'
+        if name == 'getTemperatures':
+            return self.temperatures.encode()
+        if name == 'setHeatFlow':
+            return b'0'
+        if name == 'protocolVersion' and self.protocol_version:
+            return ('%d %d'%(self.protocol_version, self.max_baudrate)).encode()
+        if name == 'switchProtocol' and self.protocol_version and 0 < int(argument) <= self.max_baudrate:
+            return b'0'
+        return None
+
+
+class SerialTestCase(unittest.TestCase):
+    '''Run a `SerialManager` against a `FakeArduino`, without the waits for the Arduino to boot.
+
+    The USB reset is simulated by resetting the fake and the communication
+    log is buffered by a separate writer, flushed to a temporary database.'''
+    def setUp(self):
+        self.sleeps = []
+        sleep = time.sleep
+        def short_sleep(seconds):
+            self.sleeps.append(seconds)
+            sleep(min(seconds, 0.01))
+        self.reset_failures = 0 # The number of next USB resets to fail.
+        def usbreset(command):
+            if self.reset_failures:
+                self.reset_failures -= 1
+                raise reactor.subprocess.CalledProcessError(1, command)
+            self.fake.reset()
+            return b''
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        db = database.ConnectionManager(os.path.join(directory.name, 'test.sqlite'))
+        db.execute('''CREATE TABLE communication_log (
+                          timestamp TIMESTAMP PRIMARY KEY DEFAULT CURRENT_TIMESTAMP NOT NULL,
+                          note TEXT NOT NULL)''') # As in `database`.
+        self.db = db
+        self.writer = database.BufferedWriter()
+        for patch in [unittest.mock.patch.object(reactor.time, 'sleep', short_sleep),
+                      unittest.mock.patch.object(reactor.subprocess, 'check_output', usbreset),
+                      unittest.mock.patch.object(reactor, 'read_sysfs', lambda directory, name: '1'),
+                      unittest.mock.patch.object(reactor, 'writer', self.writer),
+                      unittest.mock.patch.object(database, 'db', db)]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def connect(self, **kwargs):
+        self.fake = FakeArduino(**kwargs)
+        self.addCleanup(self.fake.close)
+        manager = reactor.SerialManager(self.fake.port)
+        self.addCleanup(lambda: manager.serial.close())
+        return manager
+
+    def communication_log(self):
+        self.writer.flush()
+        with self.db:
+            return [_[0] for _ in self.db.execute('''SELECT note FROM communication_log''')]
+
+
+class TestProtocols(SerialTestCase):
+    def test_binary(self):
+        manager = self.connect()
+        self.assertEqual(manager.protocol, 'binary')
+        self.assertEqual(manager.serial.baudrate, 115200)
+        self.assertEqual(manager.send(b'getTemperatures', debug=False), [23.5, 24., 24.5, 25., 25.5, 26.])
+        self.assertEqual(manager.send(b'checkHeartBeat', debug=False), [1234, 512])
+        self.assertEqual(self.fake.commands[-2:], [('binary', 'getTemperatures'), ('binary', 'checkHeartBeat')])
+        self.assertEqual(manager.resets, 0)
+
+    def test_binary_error(self):
+        manager = self.connect()
+        with self.assertRaises(reactor.ComProtocolError):
+            manager.send(b'noSuchCommand', debug=False)
+        self.assertEqual(manager.send(b'setHeatFlow 10', debug=False), [0])
+
+    def test_slower_arduino(self):
+        manager = self.connect(max_baudrate=57600)
+        self.assertEqual(manager.protocol, 'binary')
+        self.assertEqual(manager.serial.baudrate, 57600)
+        self.assertIn(('ascii', 'switchProtocol 57600'), self.fake.commands)
+
+    def test_old_sketch(self):
+        manager = self.connect(protocol_version=None)
+        self.assertEqual(manager.protocol, 'ascii')
+        self.assertEqual(manager.serial.baudrate, 9600)
+        self.assertEqual(manager.send(b'getTemperatures', debug=False), [23.5, 24., 24.5, 25., 25.5, 26.])
+        self.assertEqual(self.fake.commands, [('ascii', 'protocolVersion'), ('ascii', 'getTemperatures')])
+
+    def test_old_protocol_version(self):
+        manager = self.connect(protocol_version=1)
+        self.assertEqual(manager.protocol, 'ascii')
+        self.assertNotIn('switchProtocol', [command for __, command in self.fake.commands])
+
+    def test_fallback_to_ascii(self):
+        manager = self.connect(broken_binary=True)
+        self.assertEqual(manager.protocol, 'ascii')
+        self.assertFalse(manager.try_binary)
+        self.assertEqual(manager.resets, 1)
+        self.assertEqual(manager.send(b'checkHeartBeat', debug=False), [1234, 512])
+        self.assertEqual(self.fake.commands[-1], ('ascii', 'checkHeartBeat'))
+
+
+class TestReconnection(SerialTestCase):
+    def test_lost_command_is_sent_again(self):
+        manager = self.connect()
+        self.fake.garble = 1
+        self.assertEqual(manager.send(b'getTemperatures', debug=False), [23.5, 24., 24.5, 25., 25.5, 26.])
+        self.assertEqual(self.fake.commands.count(('binary', 'getTemperatures')), 2)
+        self.assertEqual(manager.resets, 1)
+        self.assertEqual(manager.protocol, 'binary')
+        log = self.communication_log()
+        self.assertTrue(log[0].startswith('garbled on'))
+        self.assertTrue(log[1].startswith('reconnected on %s after 1 attempts'%self.fake.port))
+
+    def test_same_second_notes(self):
+        '''The notes of a reconnection in the same second share their timestamp, only the first is stored.'''
+        manager = self.connect()
+        self.writer.now = lambda: datetime.datetime(2020, 1, 1)
+        self.fake.garble = 1
+        self.assertEqual(manager.send(b'checkHeartBeat', debug=False), [1234, 512])
+        self.assertTrue(manager.connected.is_set())
+        log = self.communication_log()
+        self.assertEqual(len(log), 1)
+        self.assertTrue(log[0].startswith('garbled on'))
+
+    def test_backoff(self):
+        manager = self.connect()
+        manager.max_backoff = 4
+        self.reset_failures = 4
+        self.fake.garble = 1
+        del self.sleeps[:]
+        self.assertEqual(manager.send(b'checkHeartBeat', debug=False), [1234, 512])
+        self.assertEqual(self.sleeps[:4], [1, 2, 4, 4])
+        self.assertEqual(manager.resets, 5)
+        self.assertIn('after 5 attempts', self.communication_log()[-1])
+        self.assertIn('5 resets', manager.report())
+
+    def test_queue_while_reconnecting(self):
+        manager = self.connect()
+        self.reset_failures = float('inf')
+        self.fake.garble = 1
+        lost = manager.submit(b'getTemperatures', debug=False)
+        while manager.connected.is_set():
+            time.sleep(0.01)
+        queued = manager.submit(b'checkHeartBeat', debug=False)
+        expiring = manager.submit(b'setHeatFlow 0', debug=False, timeout=0.1)
+        with self.assertRaises(reactor.ComProtocolError):
+            expiring.result(timeout=5)
+        behind = manager.submit(b'checkHeartBeat', debug=False, timeout=0.1) # Queued behind `lost`.
+        with self.assertRaises(reactor.ComProtocolError):
+            behind.result(timeout=5)
+        self.assertIn('reconnecting', manager.report())
+        self.assertFalse(lost.done() or queued.done())
+        self.reset_failures = 0
+        self.assertEqual(lost.result(timeout=5), [23.5, 24., 24.5, 25., 25.5, 26.])
+        self.assertEqual(queued.result(timeout=5), [1234, 512])
+        self.assertNotIn(('binary', 'setHeatFlow 0'), self.fake.commands)
+        self.assertTrue(manager.connected.is_set())
+
+
+if __name__ == '__main__':
+    unittest.main()
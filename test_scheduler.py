@@ -0,0 +1,100 @@
+'''Tests of the dispatch latency of `scheduler.ResolvedScheduler`, with real time and threads.
+
+Run with `python -m unittest test_scheduler`.'''
+import random
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from scheduler import ResolvedScheduler
+
+
+class Action:
+    '''An event action recording its lateness, holding its `resources` for `duration` seconds.'''
+    def __init__(self, resources, duration=0):
+        self.resources = frozenset(resources)
+        self.duration = duration
+        self.lateness = []
+        self.done = threading.Event()
+    def __call__(self, deadline):
+        self.lateness.append(time.monotonic()-deadline)
+        time.sleep(self.duration)
+        self.done.set()
+
+
+class SchedulerTestCase(unittest.TestCase):
+    '''Run a standalone `ResolvedScheduler` in a thread.'''
+    def setUp(self):
+        self.scheduler = ResolvedScheduler()
+        runner = threading.Thread(target=self.scheduler.run, name='TestScheduler')
+        runner.start()
+        def stop():
+            self.scheduler.stop()
+            runner.join()
+        self.addCleanup(stop)
+
+    def enter(self, delay, action):
+        deadline = time.monotonic()+delay
+        return self.scheduler.enterabs(deadline, 0, action, (deadline,))
+
+
+class TestLatency(SchedulerTestCase):
+    def test_dispatch_under_load(self):
+        '''Events keep being entered from busy threads, as the web interface and the events would.'''
+        actions = {lane: Action([lane]) for lane in ['head', 'pumps', 'sensors']}
+        done = threading.Event()
+        def load():
+            while not done.is_set():
+                sum(range(10000))
+                self.enter(random.uniform(0, 0.5), random.choice(list(actions.values())))
+                time.sleep(0.01)
+        loaders = [threading.Thread(target=load) for _ in range(4)]
+        for t in loaders:
+            t.start()
+        time.sleep(3)
+        done.set()
+        for t in loaders:
+            t.join()
+        deadline = time.monotonic()+5
+        while self.scheduler.queue and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(self.scheduler.queue)
+        lateness = np.concatenate([action.lateness for action in actions.values()])
+        self.assertGreater(len(lateness), 500)
+        self.assertTrue((lateness >= 0).all())
+        self.assertLess(np.median(lateness), 0.01)
+        self.assertLess(np.percentile(lateness, 99), 0.05)
+
+    def test_wakeup_after_enter(self):
+        '''An event entered before the one the scheduler sleeps for runs on time.'''
+        later = Action(['head'])
+        self.enter(60, later)
+        time.sleep(0.05) # The scheduler sleeps until `later`.
+        sooner = Action(['head'])
+        self.enter(0.1, sooner)
+        self.assertTrue(sooner.done.wait(1))
+        self.assertLess(sooner.lateness[0], 0.02)
+        self.assertFalse(later.done.is_set())
+
+    def test_wakeup_after_cancel(self):
+        '''An event waiting behind a cancelled one runs as soon as it is cancelled.'''
+        long = Action(['pumps'], duration=2)
+        self.enter(0, long)
+        time.sleep(0.05) # `long` holds the pumps.
+        blocking = Action(['head', 'pumps', 'sensors'])
+        event = self.enter(0, blocking)
+        waiting = Action(['sensors']) # Waits for `blocking`, which was due before it.
+        self.enter(0.01, waiting)
+        time.sleep(0.1)
+        self.assertFalse(waiting.done.is_set())
+        self.scheduler.cancel(event)
+        cancelled = time.monotonic()
+        self.assertTrue(waiting.done.wait(1))
+        self.assertLess(time.monotonic()-cancelled, 0.05)
+        self.assertFalse(long.done.is_set() or blocking.done.is_set())
+
+
+if __name__ == '__main__':
+    unittest.main()
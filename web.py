@@ -2,16 +2,22 @@ import collections
 import datetime
 import html
 import inspect
+import json
 import logging
-import time
 import threading
 import os.path
+import urllib.parse
 
 import cherrypy
 
-from database import db
-from dataprocessing import possible_plots, read_all_plottypes
-from plotting import full_plot_html
+import numpy as np
+
+from database import db, db_ro, writer, remove_archive_files
+from dataprocessing import (possible_plots, forget_experiment, forget_strain, compile_formula,
+                            invalid_formulae, read_window, downsample, read_table_window, plottype_columns,
+                            read_summaries, read_hourly_summaries, read_overviews)
+from export import stream_archive, export_formats, default_format, file_name
+from plotting import full_plot_html, cached_full_plot_html
 from scheduler import events, current_experiment, reactor_scheduler, StartExperiment
 
 logger = logging.getLogger('webinterface')
@@ -186,9 +192,9 @@ def format_new_html():
                              HTMLevent_arguments=format_event_arguments(e))
                            for e in events])
     eventbuttons_html=' '.join([t_new_event_button.format(event_name=e.__name__) for e in events])
-    with db:
+    with db_ro:
         strainoptions_html=''.join('''<option value="{name}">{name}</option>'''.format(**r)
-                                   for r in db.execute('SELECT name FROM strains ORDER BY name ASC'))
+                                   for r in db_ro.execute('SELECT name FROM strains ORDER BY name ASC'))
     return t_main.format(HTMLmain_article=t_new.format(HTMLevents=events_html,
                                                        HTMLeventbuttons=eventbuttons_html,
                                                        HTMLstrainoptions=strainoptions_html))
@@ -200,36 +206,40 @@ def format_new_html():
 
 t_archive = Template('''
 <h1>Archive</h1>
-<script src="/web_resources/list.1.2.0.min.js"></script>
 <div id='experiments'>
 <div>
-    <form class="pure-form">
+    <form class="pure-form" action="/archive" method="get">
     <fieldset>
     <legend>Search and sort experiments:</legend>
-    <input class="list_search" placeholder="Search">
-    <button type="button" class="list_sort pure-button" data-sort="list_name">     Sort by name         </button>
-    <button type="button" class="button-xsmall pure-button" onClick="experimentsList.sort('list_name',     {{order:'desc'}});">invert</button>
-    <button type="button" class="list_sort pure-button" data-sort="list_timestamp">Sort by starting time</button>
-    <button type="button" class="button-xsmall pure-button" onClick="experimentsList.sort('list_timestamp',{{order:'desc'}});">invert</button>
-    <button type="button" class="list_sort pure-button" data-sort="list_strain">  Sort by strain      </button>
-    <button type="button" class="button-xsmall pure-button" onClick="experimentsList.sort('list_strain',  {{order:'desc'}});">invert</button>
+    <input name="search" placeholder="Search" value="{search}">
+    <select name="sort">
+        <option value="timestamp" {timestamp_selected}>Sort by starting time</option>
+        <option value="name" {name_selected}>Sort by name</option>
+        <option value="strain_name" {strain_name_selected}>Sort by strain</option>
+    </select>
+    <select name="order">
+        <option value="desc" {desc_selected}>Descending</option>
+        <option value="asc" {asc_selected}>Ascending</option>
+    </select>
+    <button type="submit" class="pure-button pure-button-primary">Search</button>
     </fieldset>
     </form>
 </div>
-<ul class='list_list boxed-list'>
+{HTMLpages}
+<ul class='boxed-list'>
 {HTMLarchive_entries}
 </ul>
+{HTMLpages}
 </div>
-<script>
-var options = {{
-  valueNames: [ 'list_name', 'list_timestamp', 'list_strain', 'list_description', 'list_rows', 'list_cols', 'list_description', 'list_notes' ],
-  listClass: 'list_list',
-  searchClass: 'list_search',
-  sortClass: 'list_sort'
-}};
+''')
 
-var experimentsList = new List('experiments', options);
-</script>
+# Template for the navigation between the pages of the archive.
+t_archive_pages = Template('''
+<div class="pure-button-group">
+<a class="pure-button" href="/archive?{previous}">Previous</a>
+<span>Page {page} of {pages} ({count} experiments)</span>
+<a class="pure-button" href="/archive?{next}">Next</a>
+</div>
 ''')
 
 # A template for an entry in the list of experiments.
@@ -247,6 +257,14 @@ t_archive_entry = Template('''
         <dd><time class="list_timestamp">{timestamp:%Y-%m-%d %H:%M:%S}</time></dd>
         <dt>Strain:</dt>
         <dd class="list_strain"><a href="/strain/{strain_name}">{strain_name}</a></dd>
+        <dt>Duration:</dt>
+        <dd>{duration}</dd>
+        <dt>Measurements:</dt>
+        <dd>{measurements}</dd>
+        <dt>Temperature:</dt>
+        <dd>{temperature}</dd>
+        <dt>Final OD:</dt>
+        <dd>{final_od}</dd>
         </dl>
         <table class="pure-table">
         <thead><tr><th>R#</th><th>Notes</th></tr></thead>
@@ -272,14 +290,53 @@ t_archive_entry = Template('''
 </li>
 ''')
 
-def format_archive_html():
-    '''Load all experiments from the database and list them in the HTML template.'''
-    with db:
-        entries = '\n'.join(t_archive_entry.format(HTMLnotes=format_notes_html(r['name']),
-                                                   **r)
-                            for r in db.execute('''SELECT * FROM experiments
-                                                   ORDER BY timestamp DESC'''))
-    return t_main.format(HTMLmain_article=t_archive.format(HTMLarchive_entries=entries))
+def format_overview(overview):
+    '''Format the values of an overview (see `dataprocessing.read_overviews`) for the archive entries.'''
+    return {'duration': str(overview['duration']).split('.')[0] if overview['duration'] is not None else '-',
+            'measurements': overview['measurements'],
+            'temperature': '%.2f±%.2f°C'%(overview['temperature'], overview['temperature std'])
+                           if overview['temperature'] is not None else '-',
+            'final_od': '%.3f'%overview['final OD'] if overview['final OD'] is not None else '-'}
+
+archive_sort_columns = ['timestamp', 'name', 'strain_name']
+
+def format_archive_html(search='', sort='timestamp', order='desc', page=1, per_page=20):
+    '''List a page of the experiments matching a search (in their name, description, strain or notes).
+
+    The page is loaded with a query for the experiments and a single query for
+    all of their notes, and rendered after the connection is released.'''
+    if sort not in archive_sort_columns or order not in ('asc', 'desc'):
+        raise ValueError('Unknown sorting order.')
+    condition = '''name LIKE :search OR description LIKE :search OR strain_name LIKE :search
+                   OR EXISTS (SELECT 1 FROM notes WHERE notes.experiment_name=experiments.name
+                              AND note LIKE :search)'''
+    params = {'search': '%%%s%%'%search}
+    with db_ro:
+        count, = db_ro.execute('''SELECT count(*) FROM experiments WHERE %s'''%condition, params).fetchone()
+        pages = max(1, -(-count//per_page))
+        page = min(max(1, page), pages)
+        rows = db_ro.execute('''SELECT * FROM experiments WHERE %s
+                                ORDER BY %s %s LIMIT :limit OFFSET :offset'''%(condition, sort, order),
+                             dict(params, limit=per_page, offset=(page-1)*per_page)).fetchall()
+        names = [r['name'] for r in rows]
+        notes = collections.defaultdict(list)
+        for n in db_ro.execute('''SELECT experiment_name, timestamp, note FROM notes
+                                   WHERE experiment_name IN (%s)
+                                   ORDER BY timestamp DESC'''%', '.join('?'*len(names)), names):
+            notes[n['experiment_name']].append(n)
+    overviews = read_overviews([(r['name'], r['strain_name']) for r in rows])
+    entries = '\n'.join(t_archive_entry.format(HTMLnotes=format_notes_html(r['name'], notes[r['name']]),
+                                               **dict(format_overview(overviews[r['name']]), **r))
+                        for r in rows)
+    link = lambda page: urllib.parse.urlencode({'search': search, 'sort': sort, 'order': order, 'page': page})
+    pages_html = t_archive_pages.format(page=page, pages=pages, count=count,
+                                        previous=link(max(1, page-1)), next=link(min(pages, page+1)))
+    selected = {'%s_selected'%_: 'selected' if _ in (sort, order) else ''
+                for _ in archive_sort_columns+['asc', 'desc']}
+    return t_main.format(HTMLmain_article=t_archive.format(HTMLarchive_entries=entries,
+                                                           HTMLpages=pages_html,
+                                                           search=search,
+                                                           **selected))
 
 
 # Template for presenting a note.
@@ -310,13 +367,14 @@ t_note = Template('''
 </li>
 ''')
 
-def format_notes_html(experiment):
-    '''Prepare an AJAX-ish list of all notes for a given experiment.'''
-    with db:
-        notes = db.execute('''SELECT timestamp, note FROM notes
-                              WHERE experiment_name=?
-                              ORDER BY timestamp DESC''',
-                           (experiment,))
+def format_notes_html(experiment, notes=None):
+    '''Prepare an AJAX-ish list of all notes for a given experiment (the notes are loaded unless given).'''
+    if notes is None:
+        with db_ro:
+            notes = db_ro.execute('''SELECT timestamp, note FROM notes
+                                     WHERE experiment_name=?
+                                     ORDER BY timestamp DESC''',
+                                  (experiment,)).fetchall()
     return t_note_main.format(HTMLnotes='\n'.join(t_note.format(**r) for r in notes),
                               experiment_name=experiment)
 
@@ -367,8 +425,8 @@ def format_experiment_html(experiment):
                       '''.format(experiment=experiment,
                                  plot_type=p)
                       for p in possible_plots.keys())
-    with db:
-        query = db.execute('''SELECT * FROM experiments WHERE name=?''',
+    with db_ro:
+        query = db_ro.execute('''SELECT * FROM experiments WHERE name=?''',
                            (experiment,))
         r = query.fetchone()
     return t_main.format(HTMLmain_article=t_experiment.format(
@@ -387,7 +445,13 @@ t_status = Template('''
 <div class="pure-g">
 <div class="pure-u-1"><a class="pure-button button-error" href="/stop">Stop</a></div>
 <div class="pure-u-1"><a href="/experiment/{experiment_name}">{experiment_name}</a> (<a href="/strain/{strain}">{strain}</a>): {description}</div>
-<div class="pure-u-3-4">plots</div>
+<div class="pure-u-3-4" id="live" data-experiment="{experiment_name}">
+    <h4>Latest Measurements</h4>
+    <table class="pure-table">
+    <thead><tr><th>Quantity</th><th>Mean</th><th>Min</th><th>Max</th><th>Time</th></tr></thead>
+    <tbody id="latest_measurements"></tbody>
+    </table>
+</div>
 <div class="pure-u-1-4">
     <div id="schedule">
         {HTMLschedule}
@@ -403,12 +467,22 @@ t_status = Template('''
 t_schedule = Template('''
         <h4>Schedule</h4>
         <div class="list_notes max-height-scroll">
-        <ul class="boxed-list">
+        <ul class="boxed-list" id="schedule_events">
         {HTMLevents}
         </ul>
         </div>
+        <h4>Lanes</h4>
+        <table class="pure-table">
+        <thead><tr><th>Lane</th><th>Runs</th><th>Delay (mean/max)</th><th>Drift</th></tr></thead>
+        <tbody id="schedule_lanes">
+        {HTMLlanes}
+        </tbody>
+        </table>
 ''')
 
+# Template for the delay statistics of a lane.
+t_lane = Template('''<tr><td>{lane}</td><td>{stats[runs]}</td><td>{stats[mean delay]:.1f}s/{stats[max delay]:.1f}s</td><td>{stats[drift]:.0f}s</td></tr>''')
+
 # Template for presenting an event.
 t_event = Template('''
 <li class="event" data-priority="{event.priority}" data-waiting="{waiting}">
@@ -418,21 +492,25 @@ t_event = Template('''
 
 def format_schedule_html():
     '''Create an HTML tree for the current schedule.'''
+    now = reactor_scheduler.timefunc()
     events_html = '\n'.join(t_event.format(event=e,
-                                           time=e.time-time.monotonic(),
-                                           waiting = 0 if e.time-time.monotonic()>0 else 1)
+                                           time=(e.time-now)/reactor_scheduler.speed,
+                                           waiting = 0 if e.time-now>0 else 1)
                             for e in reactor_scheduler.queue)
-    current_html = '<li class="event current-event">{0.action.__class__.__name__}<span> currently</span><div class="loader"></div></li>'.format(s.current) if s.current else ''
+    current_html = ''.join('<li class="event current-event">{0.action.__class__.__name__}<span> currently</span><div class="loader"></div></li>'.format(e)
+                           for e in list(reactor_scheduler.running))
     events_html = current_html+events_html
-    return t_schedule.format(HTMLevents=events_html)
+    lanes_html = '\n'.join(t_lane.format(lane=lane, stats=stats)
+                           for lane, stats in sorted(reactor_scheduler.stats.items()))
+    return t_schedule.format(HTMLevents=events_html, HTMLlanes=lanes_html)
 
 def format_status_html():
     '''Create a status page for the current experiment.'''
     if current_experiment is None:
         return t_main.format(HTMLmain_article='<h1>No Experiments Running</h1>')
     logger.info('Generating status page for experiment %s...', current_experiment)
-    with db:
-        c = db.execute('''SELECT strain_name, description FROM experiments
+    with db_ro:
+        c = db_ro.execute('''SELECT strain_name, description FROM experiments
                        WHERE name=?''',
                        (current_experiment,))
         strain, description = c.fetchone()
@@ -443,6 +521,83 @@ def format_status_html():
                                                           HTMLnotes=format_notes_html(current_experiment)))
 
 
+###############################################################################
+# Live updates of the status page (Server-Sent Events).
+###############################################################################
+
+def schedule_delta():
+    '''The current schedule as a JSON delta (in real seconds from now).'''
+    now = reactor_scheduler.timefunc()
+    return {'type': 'schedule',
+            'events': [{'name': type(e.action).__name__,
+                        'priority': e.priority,
+                        'seconds': (e.time-now)/reactor_scheduler.speed}
+                       for e in reactor_scheduler.queue],
+            'running': [type(e.action).__name__ for e in list(reactor_scheduler.running)],
+            'lanes': {lane: dict(stats) for lane, stats in reactor_scheduler.stats.items()}}
+
+class LiveFeed:
+    '''Publish small JSON deltas to every connected status page.
+
+    Each client streams from `stream` in its own server thread. Recent deltas
+    are kept in a bounded backlog, so slow clients lose the oldest ones instead
+    of slowing down the publishers (the scheduler and the writer threads).
+    Schedule changes are only flagged by the publishers and are coalesced in a
+    single snapshot by each client.'''
+    def __init__(self, backlog=1000, keepalive=15):
+        self.changed = threading.Condition()
+        self.deltas = collections.deque(maxlen=backlog)
+        self.sequence = 0
+        self.keepalive = keepalive
+        self.closed = False
+    def publish(self, delta):
+        with self.changed:
+            self.sequence += 1
+            self.deltas.append((self.sequence, delta))
+            self.changed.notify_all()
+    def close(self):
+        '''End all streams (on server shutdown).'''
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+    def stream(self):
+        '''Yield Server-Sent Events, starting with a snapshot of the schedule.'''
+        with self.changed:
+            seen = self.sequence
+        yield 'retry: 5000\n\ndata: %s\n\n'%json.dumps(schedule_delta())
+        while not self.closed:
+            with self.changed:
+                self.changed.wait_for(lambda: self.closed or self.sequence > seen, self.keepalive)
+                deltas = [d for s, d in self.deltas if s > seen]
+                seen = self.sequence
+            if not deltas:
+                yield ': keepalive\n\n' # Also detects closed connections.
+                continue
+            schedule_changed = any(d['type'] == 'schedule' for d in deltas)
+            deltas = [d for d in deltas if d['type'] != 'schedule']
+            if schedule_changed:
+                deltas.append(schedule_delta())
+            yield ''.join('data: %s\n\n'%json.dumps(d) for d in deltas)
+
+live_feed = LiveFeed()
+reactor_scheduler.listeners.append(lambda: live_feed.publish({'type': 'schedule'}))
+
+def publish_measurement(table, columns):
+    '''Publish the summary of a new measurement (called by the writer for each queued row).'''
+    data = columns.get('data')
+    if '__' not in table or data is None:
+        return
+    live_feed.publish({'type': 'measurement',
+                       'table': table,
+                       'experiment': columns.get('experiment_name'),
+                       'timestamp': '{:%Y-%m-%d %H:%M:%S}'.format(columns['timestamp']),
+                       'mean': float(data.mean()),
+                       'min': float(data.min()),
+                       'max': float(data.max())})
+
+writer.listeners.append(publish_measurement)
+
+
 ###############################################################################
 # The list of strains template.
 ###############################################################################
@@ -499,18 +654,27 @@ t_strains_entry = Template('''
             <dt>Optical Density to Cell Count</dt>
             <dd>`color(black)({od_to_cell_count_formula})`</dd>
         </dl>
+        {HTMLformula_errors}
         </div>
     </div>
 </li>
 ''')
 
+t_formula_error = Template('''<p><strong>Invalid formula:</strong> {error}</p>''')
+
 def format_strains_html():
-    '''Load all strains from the database and list them in the HTML template.'''
-    with db:
+    '''Load all strains from the database and list them in the HTML template.
+
+    Stored formulae which are not permitted anymore are pointed out (the strain should be edited).'''
+    errors = collections.defaultdict(list)
+    for strain, column, error in invalid_formulae():
+        errors[strain].append(t_formula_error.format(error=error))
+    with db_ro:
         translate_power_sign = lambda _: {k: _[k].replace('**', '^') if _[k] and k not in ('name', 'description') else _[k]
                                           for k in _.keys()}
-        entries = '\n'.join(t_strains_entry.format(**translate_power_sign(r))
-                            for r in db.execute('''SELECT * FROM strains
+        entries = '\n'.join(t_strains_entry.format(HTMLformula_errors='\n'.join(errors[r['name']]),
+                                                   **translate_power_sign(r))
+                            for r in db_ro.execute('''SELECT * FROM strains
                                                    ORDER BY name ASC'''))
     return t_main.format(HTMLmain_article=t_strains.format(HTMLstrains_entries=entries))
 
@@ -561,8 +725,8 @@ t_addedit_strain = Template('''
 def format_addedit_strain_html(strain=None):
     '''Load a strain in an edit page or show a "new strain" page.'''
     if strain:
-        with db:
-            c = db.execute('''SELECT * FROM strains WHERE name=?''', (strain,))
+        with db_ro:
+            c = db_ro.execute('''SELECT * FROM strains WHERE name=?''', (strain,))
             strain = c.fetchone()
         return t_main.format(HTMLmain_article=t_addedit_strain.format(**strain))
     else:
@@ -575,26 +739,109 @@ def format_addedit_strain_html(strain=None):
 ###############################################################################
 
 t_table = Template('''
-<h1>Data Table with interpolated values</h1>
+<h1>Data Table</h1>
 <h2>{experiment}</h2>
 <form class="pure-form">
 <div class="pure-g">
 <div class="pure-u-1-4">
-<a class="pure-input-1 pure-button pure-button-primary" href="/downloadcsv/{experiment}?interpolate=True">Download CSV (interpolated)</a>
+<a class="pure-input-1 pure-button pure-button-primary" href="/export?experiments={experiment_url}">Download</a>
 </div>
 <div class="pure-u-1-4">
-<a class="pure-input-1 pure-button pure-button-primary" href="/downloadcsv/{experiment}?interpolate=False">Download CSV</a>
+<a class="pure-input-1 pure-button pure-button-primary" href="/export?experiments={experiment_url}&amp;format=npz">Download (NPZ)</a>
 </div>
 </div>
 </form>
-{HTMLtable}
+<div class="pure-button-group">
+<a class="pure-button" href="/table/{experiment_url}?resolution={resolution}">First</a>
+<a class="pure-button" href="/table/{experiment_url}?before={first}&amp;rows={rows}&amp;resolution={resolution}">Previous</a>
+<a class="pure-button" href="/table/{experiment_url}?after={last}&amp;rows={rows}&amp;resolution={resolution}">Next</a>
+<a class="pure-button" href="/table/{experiment_url}?rows={rows}">Measurements</a>
+<a class="pure-button" href="/table/{experiment_url}?rows={rows}&amp;resolution=60">Interpolated (1 min)</a>
+</div>
 ''')
 
-def format_table(experiment):
-    '''Display a data table as HTML.'''
-    table_html = read_all_plottypes(experiment, interpolate=True).to_html()
-    return t_main.format(HTMLmain_article=t_table.format(experiment=experiment,
-                                                         HTMLtable=table_html))
+def format_table(experiment, after=None, before=None, rows=500, resolution=None, chunk=100):
+    '''Stream a page of the data table as HTML (`rows` rows after or before the given timestamps).
+
+    With a `resolution` (in seconds) the values are interpolated on a grid.'''
+    window, frames = read_table_window(experiment, rows, after, before, resolution) # Before streaming, to fail early.
+    return table_chunks(experiment, rows, resolution, window, frames, after, before, chunk)
+
+def table_chunks(experiment, rows, resolution, window, frames, after, before, chunk):
+    head, tail = t_main.format(HTMLmain_article='\0').split('\0')
+    quote = lambda _: urllib.parse.quote(str(_))
+    yield head
+    yield t_table.format(experiment=experiment, experiment_url=quote(experiment), rows=rows, resolution=resolution or '',
+                         first=quote(window[0] if len(window) else before or ''),
+                         last=quote(window[-1] if len(window) else after or ''))
+    yield '<table class="dataframe pure-table">\n<thead>\n<tr><th></th>%s</tr>\n<tr><th>timestamp</th>%s</tr>\n</thead>\n<tbody>\n'%(
+          ''.join('<th colspan="%d">%s</th>'%(len(plottype_columns), html.escape(_)) for _ in possible_plots),
+          ''.join('<th>%s</th>'%_ for _ in plottype_columns)*len(possible_plots))
+    values = [df.values for df in frames]
+    for start in range(0, len(window), chunk):
+        yield ''.join('<tr><th>%s</th>%s</tr>\n'%(window[i], ''.join('<td>%s</td>'%('' if v != v else '%.4g'%v)
+                                                                   for vs in values for v in vs[i]))
+                      for i in range(start, min(start+chunk, len(window))))
+    yield '</tbody>\n</table>\n'
+    yield tail
+
+
+###############################################################################
+# Columnar JSON data for scripts and the web UI.
+###############################################################################
+
+def columnar_json(df, chunk=10000):
+    '''Yield the JSON of a dataframe in chunks, as `{"timestamp": [...], column: [...], ...}`.
+
+    The timestamps are in milliseconds since the epoch (UTC), the values have
+    7 significant digits and missing (or infinite, which JSON lacks) values are null.'''
+    def join(values, fmt):
+        for i in range(0, len(values), chunk):
+            part = values[i:i+chunk]
+            yield (',' if i else '')+','.join(fmt%v if finite else 'null' for v, finite in zip(part, np.isfinite(part)))
+    yield '{"timestamp":['
+    yield from join(df.index.values.astype('datetime64[ms]').astype('i8'), '%d')
+    yield ']'
+    for column in df.columns:
+        yield ',%s:['%json.dumps(column)
+        yield from join(df[column].values, '%.7g')
+        yield ']'
+    yield '}'
+
+class Api:
+    @cherrypy.expose
+    def data(self, experiment, plot_type, wells=None, start=None, end=None, max_points=None, method='mean'):
+        '''Stream the columns (comma separated `wells`, e.g. `11,12,avg`, all by default) of a plot type as JSON.
+
+        The rows are restricted to the `start`/`end` timestamps and downsampled
+        to `max_points` if given (see `dataprocessing.downsample` for the methods).'''
+        if plot_type not in possible_plots:
+            raise cherrypy.HTTPError(400, 'No such plot type.')
+        try:
+            df = read_window(experiment, possible_plots[plot_type],
+                             columns=wells.split(',') if wells else None,
+                             start=start, end=end)
+            df = downsample(df, int(max_points) if max_points else None, method)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return columnar_json(df)
+    data._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def summary(self, experiment, quantity=None):
+        '''Return the summaries of an experiment as JSON (with the hourly rollups of a quantity if given).'''
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        with db_ro:
+            row = db_ro.execute('''SELECT strain_name FROM experiments WHERE name=?''', (experiment,)).fetchone()
+        if row is None:
+            raise cherrypy.HTTPError(404, 'No such experiment.')
+        summary = {'overview': read_overviews([(experiment, row['strain_name'])])[experiment],
+                   'summaries': json.loads(read_summaries(experiment).to_json(orient='records', date_format='iso'))}
+        if quantity is not None:
+            hourly = read_hourly_summaries(experiment, quantity).reset_index()
+            summary['hourly'] = json.loads(hourly.to_json(orient='records', date_format='iso'))
+        return json.dumps(summary, default=str)
 
 
 ###############################################################################
@@ -602,6 +849,8 @@ def format_table(experiment):
 ###############################################################################
 
 class Root:
+    api = Api()
+
     @cherrypy.expose
     def index(self):
         return format_status_html()
@@ -610,6 +859,14 @@ class Root:
     def schedule(self):
         return format_schedule_html()
 
+    @cherrypy.expose
+    def live(self):
+        '''Server-Sent Events with the changes of the schedule, the measurements and the notes.'''
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return live_feed.stream()
+    live._cp_config = {'response.stream': True}
+
     @cherrypy.expose
     def stop(self):
         if not any(isinstance(_.action, StopExperiment)
@@ -618,8 +875,8 @@ class Root:
         raise cherrypy.HTTPRedirect('/')
 
     @cherrypy.expose
-    def archive(self):
-        return format_archive_html()
+    def archive(self, search='', sort='timestamp', order='desc', page='1'):
+        return format_archive_html(search, sort, order, int(page))
 
     @cherrypy.expose
     def experiment(self, name):
@@ -627,7 +884,7 @@ class Root:
 
     @cherrypy.expose
     def experiment_full_plot(self, name, plot_type):
-        return full_plot_html(experiment, plot_type)
+        return full_plot_html(name, plot_type)
 
     @cherrypy.expose
     def new(self):
@@ -642,8 +899,33 @@ class Root:
         return format_addedit_strain_html(strain)
 
     @cherrypy.expose
-    def table(self, experiment):
-        return format_table(experiment)
+    def table(self, experiment, after=None, before=None, rows='500', resolution=None):
+        try:
+            return format_table(experiment, after or None, before or None, min(int(rows), 5000),
+                                float(resolution) if resolution else None)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+    table._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def export(self, experiments, format=default_format):
+        '''Stream a zip archive of the given (comma separated) experiments (see `export.export_steps`).'''
+        if format not in export_formats:
+            raise cherrypy.HTTPError(400, 'The export format should be one of %s.'%', '.join(export_formats))
+        experiments = experiments.split(',')
+        if len(set(experiments)) < len(experiments) or any(not _ or '/' in _ or '\\' in _ for _ in experiments):
+            raise cherrypy.HTTPError(400, 'The experiment names should be distinct, non-empty and without slashes.')
+        with db_ro:
+            known = {_[0] for _ in db_ro.execute('''SELECT name FROM experiments WHERE name IN (%s)'''%(
+                                                 ','.join('?'*len(experiments))), experiments)}
+        unknown = [_ for _ in experiments if _ not in known]
+        if unknown:
+            raise cherrypy.HTTPError(404, 'No such experiment: %s.'%', '.join(unknown))
+        cherrypy.response.headers['Content-Type'] = 'application/zip'
+        cherrypy.response.headers['Content-Disposition'] = 'attachment; filename="%s.zip"'%(
+            file_name(experiments[0]) if len(experiments) == 1 else 'experiments')
+        return stream_archive(experiments, format)
+    export._cp_config = {'response.stream': True}
 
     @cherrypy.expose
     def do_delete(self, table, entry):
@@ -652,9 +934,17 @@ class Root:
                'strains'    : 'name',
                'notes'      : 'timestamp'}
         primary_key = ids[table]
+        archived = {'experiments': 'name', 'strains': 'strain_name'} # The deleted experiments.
         with db:
+            files = [_[0] for _ in db.execute('''SELECT file FROM archives JOIN experiments ON experiment_name=name
+                                                 WHERE %s=?'''%archived[table], (entry,))] if table in archived else []
             db.execute('''DELETE FROM %s WHERE %s=?'''%(table, primary_key),
                        (entry,))
+        remove_archive_files(files)
+        if table == 'experiments':
+            forget_experiment(entry)
+        elif table == 'strains': # Deleting a strain deletes its experiments.
+            forget_experiment()
 
     @cherrypy.expose
     def do_start_new_experiment(self, **kwargs):
@@ -685,14 +975,22 @@ class Root:
     def do_add_note(self, note, experiment_name):
         '''Add a note to a given experiment.'''
         with db:
-            db.execute('''INSERT INTO notes (experiment_name, note)
-                          VALUES (?, ?)''',
-                       (experiment_name, note))
+            c = db.execute('''INSERT INTO notes (experiment_name, note)
+                              VALUES (?, ?)''',
+                           (experiment_name, note))
+            timestamp, = db.execute('''SELECT timestamp FROM notes WHERE rowid=?''',
+                                    (c.lastrowid,)).fetchone()
+        live_feed.publish({'type': 'note',
+                           'experiment': experiment_name,
+                           'id': 'notes_%s'%timestamp,
+                           'html': t_note.format(timestamp=timestamp, note=note)})
         return format_notes_html(experiment_name)
 
     @cherrypy.expose
     def do_addedit_strain(self, name, description, light_ratio_to_od_formula,
             od_to_biomass_formula, od_to_cell_count_formula):
+        for formula in (light_ratio_to_od_formula, od_to_biomass_formula, od_to_cell_count_formula):
+            compile_formula(formula) # Raises an error for invalid formulae.
         with db:
             db.execute('''UPDATE OR IGNORE strains
                           SET description=?,
@@ -711,6 +1009,8 @@ class Root:
                           VALUES (?, ?, ?, ?, ?)''',
                        (name, description, light_ratio_to_od_formula,
                         od_to_biomass_formula, od_to_cell_count_formula))
+        forget_strain(name)
+        cached_full_plot_html.cache_clear() # The formulae are not part of the cache key.
         return t_main.format(HTMLmain_article='<h1>Strain Changes Commited!</h1>')
 
 
@@ -722,6 +1022,7 @@ def start_web_interface_thread():
     '''Start the web server in a dedicated thread. Return thread handler.'''
     cherrypy.config.update({'server.socket_host': '127.0.0.1',
 			    'server.socket_port': 8080,
+			    'server.thread_pool': 30, # Each open status page holds a thread for its live stream.
 			    'tools.encode.on'   : True,
 			    'tools.encode.encoding': 'utf-8',
 			    'engine.autoreload.on': False,
@@ -743,8 +1044,17 @@ def start_web_interface_thread():
 
     from cherrypy.lib import cpstats
     cherrypy.config.update({'tools.cpstats.on': True})
+    if not hasattr(logging, 'statistics'):
+        logging.statistics = {}
+    logging.statistics['Plot Cache'] = {
+        'Hits'    : lambda s: cached_full_plot_html.cache_info().hits,
+        'Misses'  : lambda s: cached_full_plot_html.cache_info().misses,
+        'Size'    : lambda s: cached_full_plot_html.cache_info().currsize,
+        'Max Size': lambda s: cached_full_plot_html.cache_info().maxsize,
+    }
     cherrypy.tree.mount(cpstats.StatsPage(), '/cpstats')
 
+    cherrypy.engine.subscribe('stop', live_feed.close)
     cherrypy.engine.start()
     t = threading.Thread(target=cherrypy.engine.block,
                          name='WebInterface')
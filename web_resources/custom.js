@@ -64,7 +64,72 @@ function trackSchedule() {
     NodeList.prototype[Symbol.iterator] = Array.prototype[Symbol.iterator];
     HTMLCollection.prototype[Symbol.iterator] = Array.prototype[Symbol.iterator];
     trackScheduleCallback(false);
-    setInterval(trackScheduleCallback, 1000);
+    if (!window.EventSource) {
+        setInterval(trackScheduleCallback, 1000);
+        return;
+    }
+    // The server pushes the changes, only the countdowns are updated locally.
+    setInterval(function() {trackScheduleCallback(false);}, 1000);
+    var source = new EventSource("/live");
+    source.onmessage = function(message) {applyDelta(JSON.parse(message.data));};
+}
+
+function applyDelta(delta) {
+    var experiment = document.getElementById("live").getAttribute("data-experiment");
+    if (delta.type == "schedule") {
+        applyScheduleDelta(delta);
+    } else if (delta.type == "measurement" && delta.experiment == experiment) {
+        var row = document.getElementById(`latest_${delta.table}`);
+        if (row == null) {
+            row = document.createElement("TR");
+            row.id = `latest_${delta.table}`;
+            document.getElementById("latest_measurements").appendChild(row);
+        }
+        row.innerHTML = "";
+        for (var value of [delta.table, delta.mean.toFixed(3), delta.min.toFixed(3), delta.max.toFixed(3), delta.timestamp]) {
+            var cell = document.createElement("TD");
+            cell.textContent = value;
+            row.appendChild(cell);
+        }
+    } else if (delta.type == "note" && delta.experiment == experiment) {
+        if (document.getElementById(delta.id) == null) {
+            var notes = document.querySelector(".notes_container ul");
+            notes.insertAdjacentHTML("afterbegin", delta.html);
+        }
+    }
+}
+
+function applyScheduleDelta(delta) {
+    var events = document.getElementById("schedule_events");
+    events.innerHTML = "";
+    for (var name of delta.running) {
+        var li = document.createElement("LI");
+        li.className = "event current-event";
+        li.innerHTML = "<span> currently</span><div class=\"loader\"></div>";
+        li.insertBefore(document.createTextNode(name), li.firstChild);
+        events.appendChild(li);
+    }
+    for (var e of delta.events) {
+        var li = document.createElement("LI");
+        li.className = "event";
+        li.setAttribute("data-priority", e.priority);
+        li.setAttribute("data-waiting", e.seconds > 0 ? 0 : 1);
+        li.innerHTML = `<span> in <time data-seconds="${e.seconds}">${secondsToCountdownString(e.seconds)}</time></span>`;
+        li.insertBefore(document.createTextNode(e.name), li.firstChild);
+        events.appendChild(li);
+    }
+    var lanes = document.getElementById("schedule_lanes");
+    lanes.innerHTML = "";
+    for (var lane of Object.keys(delta.lanes).sort()) {
+        var stats = delta.lanes[lane];
+        var row = document.createElement("TR");
+        for (var value of [lane, stats["runs"], `${stats["mean delay"].toFixed(1)}s/${stats["max delay"].toFixed(1)}s`, `${stats["drift"].toFixed(0)}s`]) {
+            var cell = document.createElement("TD");
+            cell.textContent = value;
+            row.appendChild(cell);
+        }
+        lanes.appendChild(row);
+    }
 }
 
 function trackScheduleCallback(permitReloads=true) {